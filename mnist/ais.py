@@ -0,0 +1,157 @@
+# coding=utf-8
+import threading
+import numpy as np
+
+from util import BackgroundWorker
+
+
+def base_rate_bias(v, eps=1e-3):
+    """
+    visible biases of the base-rate RBM (W = 0, c = 0) matching the marginals of the data
+    :param v: 2d np.ndarray, (N, n_visible), binary
+    :return: 1d np.ndarray, (n_visible, )
+    """
+    p = np.clip(np.asarray(v, np.float64).mean(axis=0), eps, 1 - eps)
+    return np.log(p / (1 - p))
+
+
+def free_energy(v, W, b, c):
+    """
+    numpy counterpart of RBM.__calc_free_energy__
+    :return: 1d np.ndarray, (N, )
+    """
+    return -np.dot(v, b) - np.logaddexp(0, np.dot(v, W) + c).sum(axis=1)
+
+
+def log_p_star(v, beta, W, b, c, base_b):
+    """
+    unnormalised log marginal of the intermediate distribution at beta, p_0 being the base-rate RBM and p_1 the RBM
+    """
+    return (1 - beta) * np.dot(v, base_b) + beta * np.dot(v, b) + np.logaddexp(0, beta * (np.dot(v, W) + c)).sum(axis=1)
+
+
+def run_ais(W, b, c, base_b, betas, n_runs, rng):
+    """
+    :return: 1d np.ndarray, (n_runs, ), the log importance weights
+    """
+    n_visible, n_hidden = W.shape
+    v = np.float64(rng.uniform(size=(n_runs, n_visible)) < 1.0 / (1.0 + np.exp(-base_b)))
+    log_w = np.zeros((n_runs,))
+    for k in range(1, len(betas)):
+        log_w += log_p_star(v, betas[k], W, b, c, base_b) - log_p_star(v, betas[k - 1], W, b, c, base_b)
+        # one Gibbs step leaving p_k invariant
+        h_proba = 1.0 / (1.0 + np.exp(-betas[k] * (np.dot(v, W) + c)))
+        h = np.float64(rng.uniform(size=h_proba.shape) < h_proba)
+        v_proba = 1.0 / (1.0 + np.exp(-((1 - betas[k]) * base_b + betas[k] * (np.dot(h, W.T) + b))))
+        v = np.float64(rng.uniform(size=v_proba.shape) < v_proba)
+    return log_w
+
+
+def ais_log_z(W, b, c, base_b=None, n_runs=100, betas=None, num_threads=1, seed=None):
+    """
+    annealed importance sampling estimate of the log partition function of an RBM, from the base-rate RBM through
+    intermediate distributions p_k(v) ~ exp((1 - beta_k) v.base_b + beta_k v.b) prod_j (1 + exp(beta_k (c_j + v W_j))).
+    the n_runs runs are advanced together as one batch, and split across num_threads threads (numpy releases the GIL)
+    :param W: 2d np.ndarray, (n_visible, n_hidden)
+    :param b: 1d np.ndarray, (n_visible, )
+    :param c: 1d np.ndarray, (n_hidden, )
+    :param base_b: visible biases of the base-rate RBM, see base_rate_bias, zeros if None
+    :param n_runs:
+    :param betas: increasing schedule from 0 to 1, 1000 evenly spaced values if None
+    :param num_threads:
+    :param seed:
+    :return: (log_z, log_z_std), the estimate and the standard deviation of the log importance weights
+    """
+    W, b, c = np.float64(W), np.float64(b), np.float64(c)
+    n_visible, n_hidden = W.shape
+    if base_b is None:
+        base_b = np.zeros((n_visible,))
+    if betas is None:
+        betas = np.linspace(0.0, 1.0, 1000)
+    log_z_base = np.logaddexp(0, base_b).sum() + n_hidden * np.log(2.0)
+    rng = np.random.RandomState(seed)
+    bounds = np.linspace(0, n_runs, min(num_threads, n_runs) + 1).astype(np.int32)
+    log_w = [None] * (len(bounds) - 1)
+
+    def run(t, thread_rng):
+        log_w[t] = run_ais(W, b, c, base_b, betas, bounds[t + 1] - bounds[t], thread_rng)
+
+    threads = [threading.Thread(target=run, args=(t, np.random.RandomState(rng.randint(2 ** 31)))) for t in range(len(bounds) - 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log_w = np.concatenate(log_w)
+    m = log_w.max()
+    log_z = log_z_base + m + np.log(np.mean(np.exp(log_w - m)))
+    return log_z, log_w.std()
+
+
+def log_likelihood(v, W, b, c, log_z):
+    """
+    :param v: 2d np.ndarray, (N, n_visible)
+    :param log_z: from ais_log_z
+    :return: average log-likelihood of the rows of v
+    """
+    return -free_energy(np.float64(v), np.float64(W), np.float64(b), np.float64(c)).mean() - log_z
+
+
+class AISMonitor(object):
+    def __init__(self, validation_v, base_v=None, n_runs=100, n_betas=1000, num_threads=1, patience=None, seed=0):
+        """
+        estimate the validation log-likelihood of snapshots of an RBM in a background thread, see RBM.fit
+        :param validation_v: 2d np.ndarray, the rows whose log-likelihood is tracked
+        :param base_v: data the base-rate RBM is fitted to, validation_v if None
+        :param n_runs: AIS runs per estimate
+        :param n_betas: length of the beta schedule
+        :param num_threads: threads of each estimate
+        :param patience: number of estimates without improvement after which should_stop is True, never if None
+        :param seed:
+        """
+        self.validation_v = validation_v
+        self.base_b = base_rate_bias(validation_v if base_v is None else base_v)
+        self.n_runs = n_runs
+        self.betas = np.linspace(0.0, 1.0, n_betas)
+        self.num_threads = num_threads
+        self.patience = patience
+        self.seed = seed
+        # should_stop reads the whole history, one (step, log-likelihood) per estimate
+        self.worker = BackgroundWorker(max_results=None)
+
+    def submit(self, step, W, b, c):
+        """
+        queue the estimate for a snapshot of the parameters, taken at training step `step`, replacing a queued one
+        """
+        self.worker.submit(step, self.__estimate__, W, b, c)
+
+    def __estimate__(self, W, b, c):
+        log_z, _ = ais_log_z(W, b, c, self.base_b, self.n_runs, self.betas, self.num_threads, self.seed)
+        return log_likelihood(self.validation_v, W, b, c, log_z)
+
+    def latest(self):
+        """
+        :return: (step, log-likelihood) of the last finished estimate, None if none has finished
+        """
+        return self.worker.latest()
+
+    def history(self):
+        """
+        :return: list of (step, log-likelihood)
+        """
+        return list(self.worker.results)
+
+    def close(self):
+        """
+        stop the background thread, the estimate under way is waited for, a queued one dropped
+        """
+        self.worker.close()
+
+    def should_stop(self):
+        """
+        :return: True once the last `patience` estimates have not improved on the best before them
+        """
+        history = self.history()
+        if self.patience is None or len(history) <= self.patience:
+            return False
+        best_before = max(ll for _, ll in history[:-self.patience])
+        return all(ll <= best_before for _, ll in history[-self.patience:])
@@ -0,0 +1,195 @@
+# coding=utf-8
+import time
+import threading
+import collections
+import Queue
+import numpy as np
+import scipy.sparse
+from tensorflow.examples.tutorials.mnist import input_data
+
+
+class PendingResult(object):
+    def __init__(self, x):
+        """
+        one request waiting in a MicroBatcher
+        :param x: 2d np.ndarray or scipy.sparse matrix, the rows of the request
+        """
+        self.x = x
+        self.enqueued = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def get(self, timeout=None):
+        """
+        wait for the result
+        :return: the rows of the predictions of this request
+        """
+        if not self.done.wait(timeout):
+            raise Exception("request timed out")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class MicroBatcher(object):
+    def __init__(self, predict_fn, max_batch_size=64, max_wait_us=1000, max_latency_samples=100000, input_dim=None):
+        """
+        coalesce concurrent requests into one call of predict_fn: a daemon thread takes the first queued request, waits
+        up to max_wait_us for more, or less once max_batch_size rows are queued, runs predict_fn over the stacked rows
+        and hands every caller its own slice of the result. the requests of a batch are stacked by number of columns,
+        dtype and sparsity, so that a malformed request fails alone rather than along with the batch it joined
+        :param predict_fn: 2d np.ndarray (or scipy.sparse matrix) -> np.ndarray with one row (or element) per row,
+            e.g. SoftmaxRegressor.predict_proba, FCNN.predict_proba or FactorMach.predict
+        :param max_batch_size: rows above which a batch is flushed without waiting
+        :param max_wait_us: longest wait of the first request of a batch for others to join it, in microseconds
+        :param max_latency_samples: latencies kept for the percentiles
+        :param input_dim: if given, a request of another number of columns fails in submit
+        """
+        self.predict_fn = predict_fn
+        self.input_dim = input_dim
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_us * 1e-6
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=max_latency_samples)
+        self.batch_sizes = collections.Counter()
+        self.num_requests = 0
+        self.thread = threading.Thread(target=self.__run__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, x):
+        """
+        queue a request without waiting for it
+        :param x: 1d or 2d np.ndarray, or scipy.sparse matrix, one or a few rows
+        :return: PendingResult
+        """
+        if not scipy.sparse.issparse(x):
+            x = np.asarray(x)
+            if x.ndim == 1:
+                x = x.reshape((1, -1))
+        pending = PendingResult(x)
+        if x.ndim != 2:
+            pending.error = ValueError("x should be 1d or 2d, got {n} dimensions".format(n=x.ndim))
+        elif self.input_dim is not None and x.shape[1] != self.input_dim:
+            pending.error = ValueError("x should have {d} columns, got {c}".format(d=self.input_dim, c=x.shape[1]))
+        if pending.error is not None:
+            pending.done.set()
+            return pending
+        self.queue.put(pending)
+        return pending
+
+    def predict(self, x, timeout=None):
+        """
+        :param x: see submit
+        :return: predict_fn(x), computed along with the concurrent requests
+        """
+        return self.submit(x).get(timeout)
+
+    def stats(self):
+        """
+        :return: dict of
+            'requests': number of requests answered,
+            'p50_ms', 'p99_ms': percentiles of the latency from submit to result, over the last max_latency_samples,
+            'batch_sizes': dict, rows per predict_fn call -> number of calls
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = dict(self.batch_sizes)
+            num_requests = self.num_requests
+        stats = {'requests': num_requests, 'batch_sizes': batch_sizes, 'p50_ms': None, 'p99_ms': None}
+        if len(latencies) > 0:
+            stats['p50_ms'] = np.percentile(latencies, 50) * 1000.0
+            stats['p99_ms'] = np.percentile(latencies, 99) * 1000.0
+        return stats
+
+    def __collect__(self):
+        """
+        block for the first request, then gather more until the batch is full or the first one waited max_wait
+        :return: list of PendingResult
+        """
+        batch = [self.queue.get()]
+        num_rows = batch[0].x.shape[0]
+        deadline = batch[0].enqueued + self.max_wait
+        while num_rows < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    pending = self.queue.get(timeout=remaining)
+                else:
+                    # past the deadline, take only what is already queued
+                    pending = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            batch.append(pending)
+            num_rows += pending.x.shape[0]
+        return batch
+
+    def __predict__(self, group):
+        """
+        run predict_fn over the stacked rows of requests of one shape, an error fails these requests only
+        :param group: list of PendingResult
+        """
+        xs = [pending.x for pending in group]
+        try:
+            if scipy.sparse.issparse(xs[0]):
+                stacked = scipy.sparse.vstack(xs, format='csr')
+            else:
+                stacked = np.concatenate(xs)
+            y = self.predict_fn(stacked)
+            a = 0
+            for pending in group:
+                n = pending.x.shape[0]
+                pending.result = y[a: a + n]
+                a += n
+        except Exception as e:
+            for pending in group:
+                pending.error = e
+
+    def __run__(self):
+        while True:
+            batch = self.__collect__()
+            groups = collections.OrderedDict()
+            for pending in batch:
+                x = pending.x
+                key = (scipy.sparse.issparse(x), x.shape[1], x.dtype.str)
+                groups.setdefault(key, []).append(pending)
+            for group in groups.itervalues():
+                self.__predict__(group)
+            finished = time.time()
+            with self.lock:
+                for group in groups.itervalues():
+                    self.batch_sizes[sum(pending.x.shape[0] for pending in group)] += 1
+                self.num_requests += len(batch)
+                for pending in batch:
+                    self.latencies.append(finished - pending.enqueued)
+            for pending in batch:
+                pending.done.set()
+
+
+if __name__ == '__main__':
+    from softmax import SoftmaxRegressor
+    mnist = input_data.read_data_sets("MNIST_data/", one_hot=False)
+    softmax_regressor = SoftmaxRegressor()
+    softmax_regressor.fit(mnist.train.images, mnist.train.labels, learning_rate=1e-3, batch_size=50, num_epochs=2000, verbose=False)
+    x = mnist.test.images
+    num_threads = 64
+    num_requests = 100
+
+    def client(predict, t):
+        for i in range(num_requests):
+            predict(x[(t * num_requests + i) % x.shape[0]].reshape((1, -1)))
+
+    batcher = MicroBatcher(softmax_regressor.predict_proba, max_batch_size=64, max_wait_us=1000)
+    for name, predict in (('direct', softmax_regressor.predict_proba), ('batched', batcher.predict)):
+        threads = [threading.Thread(target=client, args=(predict, t)) for t in range(num_threads)]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print '{n}: {r:.1f} requests/sec'.format(n=name, r=num_threads * num_requests / (time.time() - t0))
+    stats = batcher.stats()
+    print 'batched latency p50 {p50:.2f} ms, p99 {p99:.2f} ms'.format(p50=stats['p50_ms'], p99=stats['p99_ms'])
+    print 'batch sizes: {h}'.format(h=sorted(stats['batch_sizes'].items()))
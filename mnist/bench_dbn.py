@@ -0,0 +1,61 @@
+# coding=utf-8
+import time
+import numpy as np
+from tensorflow.examples.tutorials.mnist import input_data
+
+from util import PackedBinaryDataset
+from dbn import pretrain_rbm_layers, sample_hidden
+
+
+def load_packed_mnist():
+    """
+    :return: (train_v, validation_v), binarized MNIST as in dbn, the training set bit-packed
+    """
+    np.random.seed(1)
+    mnist = input_data.read_data_sets("MNIST_data/", one_hot=False)
+    train_v = PackedBinaryDataset.from_dense(mnist.train.images > 0)
+    validation_v = np.float32(mnist.validation.images[np.random.permutation(mnist.validation.images.shape[0])][0:1000] > 0)
+    return train_v, validation_v
+
+
+def top_layer_mae(rbm_layers, validation_v):
+    """
+    reconstruction MAE of the top layer on the validation rows propagated through the layers below
+    """
+    x = validation_v
+    for rbm in rbm_layers[:-1]:
+        x = sample_hidden(rbm, x)
+    top = rbm_layers[-1]
+    np.random.seed(1)
+    reconstruct_x = top.gibbs_v(x, top.params['W'], top.params['b'], top.params['c'], k=1)
+    return 1.0 * np.abs(reconstruct_x - x).sum() / x.shape[0]
+
+
+def bench_pipelined_pretraining(n_hidden=(500, 500), num_epochs=2000, refresh_epochs_list=(50, 100, 500)):
+    """
+    wall time of the serial layer-wise pretraining of the stack against the pipelined one, across refresh cadences,
+    and the reconstruction MAE of the top layer to check what the stale lower snapshots cost
+    """
+    train_v, validation_v = load_packed_mnist()
+    n = len(n_hidden)
+    config = dict(n_hidden=list(n_hidden), gibbs_steps=[10] * n, batch_size=[50] * n, num_epochs=[num_epochs] * n,
+                  learning_rate=[1e-3] * n, probe_epochs=[num_epochs + 1] * n)
+    print '{m:>10} {r:>8} {t:>10} {s:>8} {e:>10}'.format(m='mode', r='refresh', t='time (s)', s='speedup', e='top MAE')
+    rows = []
+    # the pipelined runs fork, so they go first, before the serial run opens sessions in this process
+    for refresh_epochs in refresh_epochs_list:
+        t0 = time.time()
+        rbm_layers = pretrain_rbm_layers(train_v, validation_v, pipelined=True, refresh_epochs=refresh_epochs, **config)
+        rows.append(('pipelined', refresh_epochs, time.time() - t0, rbm_layers))
+    t0 = time.time()
+    rbm_layers = pretrain_rbm_layers(train_v, validation_v, **config)
+    serial_time = time.time() - t0
+    rows.insert(0, ('serial', None, serial_time, rbm_layers))
+    for mode, refresh_epochs, elapsed, rbm_layers in rows:
+        print '{m:>10} {r:>8} {t:>10.1f} {s:>8.2f} {e:>10.4f}'.format(m=mode, r='-' if refresh_epochs is None else refresh_epochs,
+                                                                    t=elapsed, s=serial_time / elapsed,
+                                                                    e=top_layer_mae(rbm_layers, validation_v))
+
+
+if __name__ == '__main__':
+    bench_pipelined_pretraining()
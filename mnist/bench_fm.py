@@ -0,0 +1,182 @@
+# coding=utf-8
+import time
+import resource
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+from tensorflow.examples.tutorials.mnist import input_data
+
+from fm import FactorMach
+from runtime import RUNTIME, new_token
+
+
+def build_xxt_graph(input_dim, latent_dim):
+    """
+    the former pairwise formulation of FactorMach, kept here only as the baseline of the benchmark
+    :return: (graph, train_step, X, XXT, y_)
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        w0 = tf.Variable(0.0)
+        w = tf.Variable(tf.truncated_normal([input_dim, 1], stddev=1.0/np.sqrt(input_dim), seed=0))
+        V = tf.Variable(tf.truncated_normal([input_dim, latent_dim], stddev=1.0/np.sqrt(input_dim), seed=1))
+        X = tf.placeholder(tf.float32, (None, input_dim))
+        XXT = tf.placeholder(tf.float32, (None, input_dim * input_dim))
+        y_ = tf.placeholder(tf.float32, (None,))
+        VVT = tf.matmul(V, V, transpose_a=False, transpose_b=True)
+        diag_off = tf.ones([input_dim, input_dim], tf.float32) - tf.diag(tf.ones([input_dim], tf.float32))
+        y = w0 + tf.matmul(X, w) + tf.matmul(XXT, tf.reshape(VVT * diag_off, [-1, 1]))
+        y = tf.reshape(y, [-1])
+        loss = -tf.reduce_mean(tf.log(tf.nn.sigmoid(y * y_))) + 1e-2 * tf.reduce_sum(w * w) + 1e-3 * tf.reduce_sum(V * V)
+        train_step = tf.train.AdamOptimizer(1e-3).minimize(loss)
+        init_vars = tf.initialize_all_variables()
+    return graph, train_step, init_vars, X, XXT, y_
+
+
+def run_step_benchmark(engine, input_dim, latent_dim, batch_size, num_steps, queue):
+    """
+    time the training steps of one engine in a fresh process, so that ru_maxrss reflects this configuration only
+    """
+    np.random.seed(0)
+    x = np.float32(np.random.random((batch_size, input_dim)) < 0.2)
+    y = np.float32(np.random.random((batch_size,)) < 0.5) * 2 - 1
+    if engine == 'xxt':
+        graph, train_step, init_vars, X, XXT, y_ = build_xxt_graph(input_dim, latent_dim)
+        xxt = np.apply_along_axis(lambda r: np.outer(r, r).reshape((-1)), 1, x)
+        feed_dict = {X: x, XXT: xxt, y_: y}
+    else:
+        G = FactorMach().__build_graph__(input_dim, latent_dim)
+        graph, train_step, init_vars = G.graph, G.ops.train_step, G.ops.init_vars
+        feed_dict = {G.phr.X: x, G.phr.y_: y, G.phr.learning_rate: 1e-3, G.phr.penalty_w: 1e-2, G.phr.penalty_V: 1e-3}
+    sess = tf.Session(graph=graph)
+    sess.run(init_vars)
+    sess.run(train_step, feed_dict=feed_dict)
+    t0 = time.time()
+    for i in range(num_steps):
+        sess.run(train_step, feed_dict=feed_dict)
+    step_time = (time.time() - t0) / num_steps
+    sess.close()
+    # ru_maxrss is in kilobytes on linux
+    queue.put((step_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def bench_pairwise_engines(input_dims=(64, 256, 784, 2048, 4096, 16384, 65536), latent_dim=10, batch_size=50,
+                           num_steps=20, max_xxt_dim=4096):
+    """
+    compare peak memory and step time of the former XXT/VVT graph against the linear-time pairwise engine
+    """
+    print '{d:>8} {e:>8} {t:>12} {m:>12} {f:>14}'.format(d='dim', e='engine', t='step (ms)', m='peak RSS (MB)', f='feed (MB)')
+    for input_dim in input_dims:
+        for engine in ('xxt', 'linear'):
+            if engine == 'xxt':
+                feed_mb = 4.0 * batch_size * (input_dim + input_dim * input_dim) / 2 ** 20
+            else:
+                feed_mb = 4.0 * batch_size * input_dim / 2 ** 20
+            if engine == 'xxt' and input_dim > max_xxt_dim:
+                print '{d:>8} {e:>8} {t:>12} {m:>12} {f:>14.1f}'.format(d=input_dim, e=engine, t='n/a', m='n/a', f=feed_mb)
+                continue
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run_step_benchmark, args=(engine, input_dim, latent_dim, batch_size, num_steps, queue))
+            p.start()
+            step_time, peak_rss = queue.get()
+            p.join()
+            print '{d:>8} {e:>8} {t:>12.2f} {m:>12.1f} {f:>14.1f}'.format(d=input_dim, e=engine, t=step_time * 1000.0, m=peak_rss, f=feed_mb)
+
+
+def bench_predict_backends(input_dim=784, latent_dim=10, num_single=1000, num_rows=10000):
+    """
+    latency of FactorMach.predict with the tf and numpy backends, for single-row requests and one num_rows request
+    """
+    rng = np.random.RandomState(0)
+    params = {'w0': np.float32(0.1),
+              'w': np.float32(rng.normal(0, 1.0 / np.sqrt(input_dim), (input_dim, 1))),
+              'V': np.float32(rng.normal(0, 1.0 / np.sqrt(input_dim), (input_dim, latent_dim)))}
+    x = np.float32(rng.random_sample((num_rows, input_dim)) < 0.2)
+    print '{b:>8} {c:>16} {s:>16} {l:>16}'.format(b='backend', c='first call (ms)', s='1 row (ms)', l='{n} rows (ms)'.format(n=num_rows))
+    for backend in ('tf', 'numpy'):
+        fm = FactorMach()
+        fm.params = params
+        fm.token = new_token()
+        t0 = time.time()
+        fm.predict(x[0:1], backend=backend)
+        first_call = time.time() - t0
+        t0 = time.time()
+        for i in range(num_single):
+            fm.predict(x[i: i + 1], backend=backend)
+        single_row = (time.time() - t0) / num_single
+        t0 = time.time()
+        fm.predict(x, backend=backend)
+        many_rows = time.time() - t0
+        print '{b:>8} {c:>16.2f} {s:>16.3f} {l:>16.2f}'.format(b=backend, c=first_call * 1000.0, s=single_row * 1000.0, l=many_rows * 1000.0)
+    fm = FactorMach()
+    fm.params = params
+    fm.token = new_token()
+    print 'max abs difference between backends: {d:.2e}'.format(d=np.abs(fm.predict(x, backend='tf') - fm.predict(x, backend='numpy')).max())
+
+
+def bench_model_refresh(input_dim=784, latent_dim=10, num_cycles=20, path='/tmp/bench_fm_model'):
+    """
+    latency of a load + predict cycle, as in an hourly model refresh, with a cold runtime and once the graph of the
+    architecture is cached, where load only pushes the new params into the live session
+    """
+    rng = np.random.RandomState(0)
+    fm = FactorMach()
+    fm.params = {'w0': np.float32(0.1),
+                 'w': np.float32(rng.normal(0, 1.0 / np.sqrt(input_dim), (input_dim, 1))),
+                 'V': np.float32(rng.normal(0, 1.0 / np.sqrt(input_dim), (input_dim, latent_dim)))}
+    fm.save(path)
+    x = np.float32(rng.random_sample((1, input_dim)) < 0.2)
+    RUNTIME.clear()
+    times = []
+    for i in range(num_cycles):
+        t0 = time.time()
+        fm = FactorMach()
+        fm.load(path)
+        fm.predict(x)
+        times.append(time.time() - t0)
+    print 'load + predict, cold runtime {c:.2f} ms, cached graph {w:.2f} ms'.format(c=times[0] * 1000.0, w=np.mean(times[1:]) * 1000.0)
+
+
+def load_digit_pair(digit1=5, digit2=6):
+    """
+    :return: (train_images, train_labels, test_images, test_labels), digit1 labelled 0 and digit2 labelled 1
+    """
+    mnist = input_data.read_data_sets("MNIST_data/", one_hot=False)
+    datasets = []
+    for images, labels in ((mnist.train.images, mnist.train.labels), (mnist.test.images, mnist.test.labels)):
+        m = (labels == digit1) | (labels == digit2)
+        datasets.append(images[m])
+        datasets.append(np.float32(labels[m] == digit2))
+    return tuple(datasets)
+
+
+def bench_parallel_fit(num_workers_list=(1, 2, 4, 8, 16, 32), batch_size=50, num_epochs=4000):
+    """
+    training throughput and test accuracy of Hogwild-style FactorMach.fit against the number of workers, on digit 5 vs 6
+    """
+    train_images, train_labels, test_images, test_labels = load_digit_pair()
+    # build the graph and its pool of sessions before timing, so that the first worker count does not pay for them
+    FactorMach().__runtime__(train_images.shape[1], 10, False)
+    print '{w:>8} {t:>16} {s:>10} {a:>10}'.format(w='workers', t='samples/sec', s='speedup', a='accuracy')
+    base = None
+    for num_workers in num_workers_list:
+        fm = FactorMach()
+        t0 = time.time()
+        fm.fit(train_images, train_labels,
+               latent_dim=10, penalty_w=1e-2, penalty_V=1e-3,
+               batch_size=batch_size, num_epochs=num_epochs,
+               learning_rate=1e-3,
+               verbose=False, num_workers=num_workers)
+        # the workers run ceil(num_epochs / num_workers) steps each
+        throughput = num_workers * int(np.ceil(1.0 * num_epochs / num_workers)) * batch_size / (time.time() - t0)
+        if base is None:
+            base = throughput
+        accuracy = np.mean((fm.predict(test_images) > 0) == (test_labels == 1))
+        print '{w:>8} {t:>16.1f} {s:>10.2f} {a:>9.2f}%'.format(w=num_workers, t=throughput, s=throughput / base, a=accuracy * 100.0)
+
+
+if __name__ == '__main__':
+    bench_pairwise_engines()
+    bench_predict_backends()
+    bench_model_refresh()
+    bench_parallel_fit()
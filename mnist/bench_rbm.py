@@ -0,0 +1,164 @@
+# coding=utf-8
+import time
+import resource
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+from tensorflow.examples.tutorials.mnist import input_data
+
+from rbm import RBM
+from sampling_util import GibbsBuffers, hidden_preactivation
+
+
+def load_binary_mnist():
+    """
+    :return: (train_v, validation_v), binarized MNIST as in test_rbm
+    """
+    np.random.seed(1)
+    mnist = input_data.read_data_sets("MNIST_data/", one_hot=False)
+    train_v = np.float32(mnist.train.images > 0)
+    validation_v = np.float32(mnist.validation.images[np.random.permutation(mnist.validation.images.shape[0])][0:1000] > 0)
+    return train_v, validation_v
+
+
+def bench_sample_in_graph(gibbs_steps_list=(1, 10, 15), n_hidden=500, batch_size=100, num_epochs=500):
+    """
+    training steps/sec of RBM.fit with the Gibbs chain run in numpy and in the graph
+    """
+    train_v, _ = load_binary_mnist()
+    results = []
+    for gibbs_steps in gibbs_steps_list:
+        for sample_in_graph in (False, True):
+            rbm = RBM(n_visible=28*28, n_hidden=n_hidden, gibbs_steps=gibbs_steps, batch_size=batch_size,
+                      num_epochs=num_epochs, learning_rate=1e-2, probe_epochs=num_epochs + 1, sample_in_graph=sample_in_graph)
+            t0 = time.time()
+            rbm.fit(train_v)
+            results.append((gibbs_steps, 'graph' if sample_in_graph else 'numpy', num_epochs / (time.time() - t0)))
+    print '{k:>6} {m:>8} {s:>12}'.format(k='k', m='chain', s='steps/sec')
+    for gibbs_steps, mode, steps_per_sec in results:
+        print '{k:>6} {m:>8} {s:>12.1f}'.format(k=gibbs_steps, m=mode, s=steps_per_sec)
+
+
+def bench_pcd(n_hidden=500, batch_size=100, num_epochs=2000):
+    """
+    validation reconstruction MAE and training time of CD-10 against persistent CD with 1 and 2 Gibbs steps
+    """
+    train_v, validation_v = load_binary_mnist()
+    print '{m:>8} {t:>10} {e:>10}'.format(m='method', t='time (s)', e='MAE')
+    for persistent, gibbs_steps in ((False, 10), (True, 1), (True, 2)):
+        rbm = RBM(n_visible=28*28, n_hidden=n_hidden, gibbs_steps=gibbs_steps, batch_size=batch_size,
+                  num_epochs=num_epochs, learning_rate=1e-2, probe_epochs=num_epochs + 1, persistent=persistent)
+        t0 = time.time()
+        rbm.fit(train_v)
+        elapsed = time.time() - t0
+        np.random.seed(1)
+        reconstruct_v = rbm.gibbs_v(validation_v, rbm.params['W'], rbm.params['b'], rbm.params['c'], k=1)
+        mae = 1.0 * np.abs(reconstruct_v - validation_v).sum() / validation_v.shape[0]
+        method = '{p}CD-{k}'.format(p='P' if persistent else '', k=gibbs_steps)
+        print '{m:>8} {t:>10.1f} {e:>10.4f}'.format(m=method, t=elapsed, e=mae)
+
+
+def gibbs_peak_memory(n_visible, n_hidden, batch_size, use_buffers, num_sweeps, results):
+    """
+    run in a fresh process, so that its peak resident size only reflects these sweeps. puts on results the growth of
+    the peak resident size in KB over num_sweeps sweeps, once the inputs and the buffers are in place
+    """
+    rng = np.random.RandomState(0)
+    W = np.float32(rng.normal(0, 0.01, (n_visible, n_hidden)))
+    b = np.zeros((n_visible,), np.float32)
+    c = np.zeros((n_hidden,), np.float32)
+    v0 = np.float32(rng.random_sample((batch_size, n_visible)) < 0.2)
+    buffers = None
+    if use_buffers:
+        buffers = GibbsBuffers(n_visible, n_hidden, batch_size, seed=0)
+        # touch the pages of the buffers, they are not what is measured
+        for a in (buffers.h, buffers.h_uniform, buffers.v, buffers.v_uniform):
+            a.fill(0)
+    # ru_maxrss is in KB on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    RBM.gibbs_v(v0, W, b, c, k=num_sweeps, buffers=buffers)
+    results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak)
+
+
+def bench_gibbs_kernels(n_visible=784, n_hidden=500, batch_size=100, num_sweeps=1000):
+    """
+    wall time per Gibbs sweep of RBM.gibbs_v with the allocating helpers of util and with preallocated
+    sampling_util.GibbsBuffers, and the memory the sweeps need on top of their inputs, as the growth of the peak
+    resident size of a process running 100 of them
+    """
+    rng = np.random.RandomState(0)
+    W = np.float32(rng.normal(0, 0.01, (n_visible, n_hidden)))
+    b = np.zeros((n_visible,), np.float32)
+    c = np.zeros((n_hidden,), np.float32)
+    v0 = np.float32(rng.random_sample((batch_size, n_visible)) < 0.2)
+    print '{m:>12} {t:>14} {a:>18}'.format(m='kernels', t='sweep (ms)', a='peak RSS growth')
+    for name, buffers in (('util', None), ('buffers', GibbsBuffers(n_visible, n_hidden, batch_size, seed=0))):
+        RBM.gibbs_v(v0, W, b, c, k=1, buffers=buffers)
+        t0 = time.time()
+        RBM.gibbs_v(v0, W, b, c, k=num_sweeps, buffers=buffers)
+        sweep_time = (time.time() - t0) / num_sweeps
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=gibbs_peak_memory, args=(n_visible, n_hidden, batch_size,
+                                                                         buffers is not None, 100, results))
+        worker.start()
+        allocated = '{k} KB'.format(k=results.get())
+        worker.join()
+        print '{m:>12} {t:>14.3f} {a:>18}'.format(m=name, t=sweep_time * 1000.0, a=allocated)
+
+
+def bench_sparse_hidden(densities=(0.005, 0.01, 0.02, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5), n_visible=784, n_hidden=500,
+                        batch_size=100, num_repeats=200):
+    """
+    time of the hidden pre-activations, dense matmul against gathering the active rows of W, in numpy and in the graph,
+    across input densities. binarized MNIST has a density around 0.19
+    """
+    rng = np.random.RandomState(0)
+    W_val = np.float32(rng.normal(0, 0.01, (n_visible, n_hidden)))
+    c_val = np.zeros((n_hidden,), np.float32)
+    rbm_dense = RBM(n_visible=n_visible, n_hidden=n_hidden)
+    # threshold above any density, so that the graph always takes the sparse branch
+    rbm_sparse = RBM(n_visible=n_visible, n_hidden=n_hidden, sparse_threshold=1.1)
+    graph = tf.Graph()
+    with graph.as_default():
+        v = tf.placeholder(tf.float32, [None, n_visible])
+        W = tf.Variable(W_val)
+        c = tf.Variable(c_val)
+        dense_op = rbm_dense.__hidden_preactivation_graph__(v, W, c)
+        sparse_op = rbm_sparse.__hidden_preactivation_graph__(v, W, c)
+        init_vars = tf.initialize_all_variables()
+    sess = tf.Session(graph=graph)
+    sess.run(init_vars)
+    print '{d:>8} {nd:>12} {ns:>12} {td:>12} {ts:>12}'.format(d='density', nd='numpy dense', ns='numpy sparse', td='tf dense', ts='tf sparse')
+    crossover = {'numpy': None, 'tf': None}
+    for density in densities:
+        x = np.float32(rng.random_sample((batch_size, n_visible)) < density)
+        out = np.empty((batch_size, n_hidden), np.float32)
+        times = []
+        for threshold in (None, 1.1):
+            t0 = time.time()
+            for i in range(num_repeats):
+                hidden_preactivation(x, W_val, c_val, threshold, out=out)
+            times.append((time.time() - t0) / num_repeats)
+        for op in (dense_op, sparse_op):
+            sess.run(op, feed_dict={v: x})
+            t0 = time.time()
+            for i in range(num_repeats):
+                sess.run(op, feed_dict={v: x})
+            times.append((time.time() - t0) / num_repeats)
+        if times[1] < times[0]:
+            crossover['numpy'] = density
+        if times[3] < times[2]:
+            crossover['tf'] = density
+        print '{d:>8.3f} {nd:>12.4f} {ns:>12.4f} {td:>12.4f} {ts:>12.4f}'.format(d=density, nd=times[0] * 1000.0, ns=times[1] * 1000.0,
+                                                                                td=times[2] * 1000.0, ts=times[3] * 1000.0)
+    sess.close()
+    print 'times in ms per batch of {n}'.format(n=batch_size)
+    for k in ('numpy', 'tf'):
+        print '{k}: sparse path faster up to density {d}'.format(k=k, d=crossover[k])
+
+
+if __name__ == '__main__':
+    bench_sample_in_graph()
+    bench_pcd()
+    bench_gibbs_kernels()
+    bench_sparse_hidden()
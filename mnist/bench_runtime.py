@@ -0,0 +1,87 @@
+# coding=utf-8
+import time
+import cPickle
+import threading
+import numpy as np
+
+from fnn import FCNN
+from runtime import RUNTIME, new_token
+
+
+def random_fcnn(input_dim=784, size_hidden_layer=1000, num_classes=10, seed=0):
+    """
+    :return: FCNN with random params, enough to time predict_proba
+    """
+    rng = np.random.RandomState(seed)
+    fcnn = FCNN()
+    fcnn.params = {'W_h1': np.float32(rng.normal(0, 1.0 / np.sqrt(input_dim), (input_dim, size_hidden_layer))),
+                   'b_h1': np.zeros((size_hidden_layer, ), np.float32),
+                   'W_smx': np.float32(rng.normal(0, 1.0 / np.sqrt(size_hidden_layer), (size_hidden_layer, num_classes))),
+                   'b_smx': np.zeros((num_classes, ), np.float32)}
+    fcnn.token = new_token()
+    return fcnn
+
+
+def bench_concurrent_predict(num_sessions_list=(1, 2, 4), num_threads_list=(1, 2, 4, 8, 16, 32), batch_rows=100,
+                             calls_per_thread=200, intra_op_threads=1):
+    """
+    aggregate rows/sec of FCNN.predict_proba called from several threads against the size of the session pool.
+    the sessions run single-threaded ops, so that the parallelism comes from the pool
+    """
+    x = np.float32(np.random.RandomState(1).random_sample((batch_rows, 784)) < 0.2)
+    print '{s:>9} {t:>8} {r:>12}'.format(s='sessions', t='threads', r='rows/sec')
+    for num_sessions in num_sessions_list:
+        RUNTIME.configure(num_sessions=num_sessions, intra_op_threads=intra_op_threads)
+        fcnn = random_fcnn()
+        # build the graph and warm the sessions before timing
+        warm_up = [threading.Thread(target=fcnn.predict_proba, args=(x, )) for i in range(num_sessions)]
+        for thread in warm_up:
+            thread.start()
+        for thread in warm_up:
+            thread.join()
+
+        def caller():
+            for i in range(calls_per_thread):
+                fcnn.predict_proba(x)
+
+        for num_threads in num_threads_list:
+            threads = [threading.Thread(target=caller) for t in range(num_threads)]
+            t0 = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            rows_per_sec = num_threads * calls_per_thread * batch_rows / (time.time() - t0)
+            print '{s:>9} {t:>8} {r:>12.1f}'.format(s=num_sessions, t=num_threads, r=rows_per_sec)
+    RUNTIME.configure()
+
+
+def bench_model_load(size_hidden_layers=(1000, 10000, 50000), path='/tmp/bench_fcnn_model'):
+    """
+    time of FCNN.load from the former cPickle file and from the memory-mapped directory, and of the first prediction
+    after it, across model sizes
+    """
+    x = np.float32(np.random.RandomState(1).random_sample((1, 784)) < 0.2)
+    print '{h:>8} {s:>10} {f:>8} {l:>10} {p:>16}'.format(h='hidden', s='size (MB)', f='format', l='load (ms)', p='1st predict (ms)')
+    for size_hidden_layer in size_hidden_layers:
+        fcnn = random_fcnn(size_hidden_layer=size_hidden_layer)
+        size_mb = sum(v.nbytes for v in fcnn.params.itervalues()) / 2.0 ** 20
+        fcnn.save(path)
+        with open(path + '.pkl', 'wb') as f:
+            cPickle.dump(fcnn.params, f, cPickle.HIGHEST_PROTOCOL)
+        for name, p in (('cPickle', path + '.pkl'), ('mmap', path)):
+            RUNTIME.clear()
+            fcnn = FCNN()
+            t0 = time.time()
+            fcnn.load(p)
+            load_time = time.time() - t0
+            t0 = time.time()
+            fcnn.predict_proba(x)
+            predict_time = time.time() - t0
+            print '{h:>8} {s:>10.1f} {f:>8} {l:>10.2f} {p:>16.2f}'.format(h=size_hidden_layer, s=size_mb, f=name,
+                                                                       l=load_time * 1000.0, p=predict_time * 1000.0)
+
+
+if __name__ == '__main__':
+    bench_concurrent_predict()
+    bench_model_load()
@@ -3,19 +3,30 @@ import tensorflow as tf
 import numpy as np
 import cPickle
 import copy
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import time
+import Queue
+import threading
+import traceback
+import multiprocessing
 import Image
 import matplotlib.pyplot as plt
 from tensorflow.examples.tutorials.mnist import input_data
 
 from vis_util import tile_raster_images
-from util import Struct, GraphWrapper, iterate_dataset, ordinal_to_onehot
+from util import Struct, GraphWrapper, iterate_dataset, ordinal_to_onehot, PackedBinaryDataset
 from rbm import RBM
 
 
 class DBN(object):
-    def __init__(self, rbm_layers, n_visible, num_classes, learning_rate=1e-3, batch_size=50, num_epochs=1000, probe_epochs=50):
+    def __init__(self, rbm_layers, n_visible, num_classes, learning_rate=1e-3, batch_size=50, num_epochs=1000, probe_epochs=50, finetune_rbm=True):
         """
         :param rbm_layers: list of consecutive rbm layers, properly pretrained
+        :param finetune_rbm: if False, the rbm layers are frozen and only the softmax layer is trained
         :return:
         """
         self.rbm_layers = rbm_layers
@@ -25,9 +36,22 @@ class DBN(object):
         self.batch_size = batch_size
         self.num_epochs = num_epochs
         self.probe_epochs = probe_epochs
+        self.finetune_rbm = finetune_rbm
         self.params = {}
+        # Graph and session for online running
+        self.updated = True
+        self.G_run = None
+        self.sess_run = None
+        # concurrent predict_proba calls build the running graph once, then share the session
+        self.lock = threading.Lock()
+        # session -> number of predict_proba calls running on it, a replaced session is closed by its last caller
+        self.checkouts = {}
     
-    def __build_graph__(self):
+    def __build_graph__(self, var_val=None):
+        """
+        :param var_val: params of a finetuned DBN, the variables are initialized with them instead of the rbm layers
+            and random softmax weights
+        """
         print 'building graph...'
         n_rbm_layers = len(self.rbm_layers)
         graph = tf.Graph()
@@ -39,8 +63,12 @@ class DBN(object):
             bias_list = []
             # rbm layers
             for i, rbm in zip(range(n_rbm_layers), self.rbm_layers):
-                W = tf.Variable(initial_value=rbm.params['W'], trainable=True)
-                c = tf.Variable(initial_value=rbm.params['c'], trainable=True)
+                if var_val is None:
+                    W = tf.Variable(initial_value=rbm.params['W'], trainable=self.finetune_rbm)
+                    c = tf.Variable(initial_value=rbm.params['c'], trainable=self.finetune_rbm)
+                else:
+                    W = tf.Variable(initial_value=var_val['W_list'][i], trainable=self.finetune_rbm)
+                    c = tf.Variable(initial_value=var_val['bias_list'][i], trainable=self.finetune_rbm)
                 print '{i}th rbm layer, n_visible {v}, n_hidden {h}'\
                     .format(i=i, v=rbm.params['W'].shape[0], h=rbm.params['W'].shape[1])
                 h = tf.sigmoid(tf.matmul(v, W) + c)
@@ -50,13 +78,17 @@ class DBN(object):
             # softmax layer
             n_hidden_last_rbm = self.rbm_layers[-1].params['c'].shape[0]
             print 'n_hidden_last_rbm = {n}'.format(n=n_hidden_last_rbm)
-            initial_W = np.float32(np.random.uniform(
-                low=-4 * np.sqrt(6.0 / (n_hidden_last_rbm + self.num_classes)),
-                high=4 * np.sqrt(6.0 / (n_hidden_last_rbm + self.num_classes)),
-                size=(n_hidden_last_rbm, self.num_classes)
-            ))
-            W = tf.Variable(initial_W)
-            b = tf.Variable(tf.zeros([self.num_classes]))
+            if var_val is None:
+                initial_W = np.float32(np.random.uniform(
+                    low=-4 * np.sqrt(6.0 / (n_hidden_last_rbm + self.num_classes)),
+                    high=4 * np.sqrt(6.0 / (n_hidden_last_rbm + self.num_classes)),
+                    size=(n_hidden_last_rbm, self.num_classes)
+                ))
+                W = tf.Variable(initial_W)
+                b = tf.Variable(tf.zeros([self.num_classes]))
+            else:
+                W = tf.Variable(var_val['W_list'][-1])
+                b = tf.Variable(var_val['bias_list'][-1])
             y = tf.nn.softmax(tf.matmul(v, W) + b)
             W_list.append(W)
             bias_list.append(b)
@@ -90,55 +122,302 @@ class DBN(object):
                 G.ops.train_step.run(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y})
             for k, v in G.var.iteritems():
                 self.params[k] = sess.run(v)
+        self.updated = True
     
     def fit(self, x, targets):
         self.finetune(x, targets)
 
-    def predict_proba(self, x):
-        num_samples = x.shape[0]
-        n_visible = x.shape[1]
-        print '{s} samples in R^{v}'.format(s=num_samples, v=n_visible)
-        G = self.__build_graph__()
-        sess = tf.Session(graph=G.graph)
-        with sess.as_default():
-            feed_dict = dict([(k, v) for k, v in zip(G.var.W_list, self.params['W_list'])])
-            feed_dict.update(dict([(k, v) for k, v in zip(G.var.bias_list, self.params['bias_list'])]))
-            feed_dict.update({G.phr.x: x})
-            predict = G.tsr.y.eval(feed_dict=feed_dict)
-            return predict
+    def predict_proba(self, x, chunk_size=10000):
+        """
+        :param x: 2d np.ndarray or PackedBinaryDataset
+        :param chunk_size: rows scored per session run, bounds the activations held at once
+        :return: np.2darray, each row gives the proba of an instance belonging to each class
+        """
+        if len(self.params) < 1:
+            raise Exception("empty model")
+        with self.lock:
+            if self.updated:
+                print 'updating running Graph...'
+                self.G_run = self.__build_graph__(var_val=self.params)
+                if self.sess_run is not None and self.sess_run not in self.checkouts:
+                    self.sess_run.close()
+                self.sess_run = tf.Session(graph=self.G_run.graph)
+                self.sess_run.run(self.G_run.ops.init_vars)
+                self.updated = False
+            G_run, sess_run = self.G_run, self.sess_run
+            self.checkouts[sess_run] = self.checkouts.get(sess_run, 0) + 1
+        try:
+            proba = np.zeros((x.shape[0], self.num_classes), dtype=np.float32)
+            for a in range(0, x.shape[0], chunk_size):
+                proba[a: a + chunk_size] = sess_run.run(G_run.tsr.y, feed_dict={G_run.phr.x: x[a: a + chunk_size]})
+        finally:
+            with self.lock:
+                self.checkouts[sess_run] -= 1
+                if self.checkouts[sess_run] == 0:
+                    del self.checkouts[sess_run]
+                    # replaced by a rebuild while this call was running on it
+                    if sess_run is not self.sess_run:
+                        sess_run.close()
+        return proba
 
     def predict(self, x):
         proba = self.predict_proba(x)
         return np.argmax(proba, axis=1)
 
+    def __del__(self):
+        if self.sess_run is not None:
+            self.sess_run.close()
+
+
+def sample_hidden(rbm, v, chunk_size=10000):
+    """
+    sample the hidden units of rbm given each row of v
+    :param rbm: trained RBM
+    :param v: 2d np.ndarray or PackedBinaryDataset
+    :param chunk_size: rows unpacked at a time when v is packed
+    :return: 2d np.ndarray, or PackedBinaryDataset if v is packed
+    """
+    if not isinstance(v, PackedBinaryDataset):
+        return rbm.sample_h_given_v(v, rbm.params['W'], rbm.params['c'])
+    packed = np.zeros((v.shape[0], (rbm.n_hidden + 7) // 8), dtype=np.uint8)
+    for a in range(0, v.shape[0], chunk_size):
+        h = rbm.sample_h_given_v(v[a: a + chunk_size], rbm.params['W'], rbm.params['c'])
+        packed[a: a + chunk_size] = np.packbits(h != 0, axis=1)
+    return PackedBinaryDataset(packed, rbm.n_hidden)
+
+
+def fingerprint(x, chunk_size=10000):
+    """
+    :param x: 2d np.ndarray or PackedBinaryDataset, None
+    :return: sha1 hex digest of the shape and content of x
+    """
+    h = hashlib.sha1()
+    if x is None:
+        return h.hexdigest()
+    if isinstance(x, PackedBinaryDataset):
+        h.update('packed')
+        data = x.packed
+    else:
+        data = x
+    h.update(str(x.shape))
+    h.update(str(data.dtype))
+    for a in range(0, data.shape[0], chunk_size):
+        h.update(np.ascontiguousarray(data[a: a + chunk_size]).data)
+    return h.hexdigest()
+
+
+def layer_cache_key(input_key, validation_key, rbm):
+    """
+    :return: key of a trained layer, from the fingerprints of its inputs and its hyperparameters
+    """
+    meta = {'input': input_key, 'validation': validation_key, 'n_visible': rbm.n_visible, 'n_hidden': rbm.n_hidden,
+            'gibbs_steps': rbm.gibbs_steps, 'learning_rate': rbm.learning_rate, 'num_epochs': rbm.num_epochs,
+            'batch_size': rbm.batch_size}
+    return hashlib.sha1(json.dumps(meta, sort_keys=True)).hexdigest()
+
 
-def pretrain_rbm_layers(v, validation_v=None, n_hidden=[], gibbs_steps=[], batch_size=[], num_epochs=[], learning_rate=[], probe_epochs=[]):
+def save_layer(path, rbm, output, validation_output):
+    """
+    write the params of a trained layer and its hidden outputs under path, atomically
+    """
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    for k in ('W', 'b', 'c'):
+        np.save(os.path.join(tmp_path, k + '.npy'), rbm.params[k])
+    for name, x in (('hidden', output), ('validation_hidden', validation_output)):
+        if x is None:
+            continue
+        np.save(os.path.join(tmp_path, name + '.npy'), x.packed if isinstance(x, PackedBinaryDataset) else x)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'packed': isinstance(output, PackedBinaryDataset), 'n_hidden': rbm.n_hidden}, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # written concurrently by another run
+        shutil.rmtree(tmp_path)
+
+
+def load_layer(path, rbm):
+    """
+    set the params of rbm from the cache entry at path
+    :return: (output, validation_output), memory-mapped, validation_output None if it was not cached
+    """
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    for k in ('W', 'b', 'c'):
+        rbm.params[k] = np.load(os.path.join(path, k + '.npy'))
+    outputs = []
+    for name in ('hidden', 'validation_hidden'):
+        file_path = os.path.join(path, name + '.npy')
+        if not os.path.exists(file_path):
+            outputs.append(None)
+            continue
+        x = np.load(file_path, mmap_mode='r')
+        outputs.append(PackedBinaryDataset(x, meta['n_hidden']) if meta['packed'] else x)
+    return tuple(outputs)
+
+
+def pipeline_worker(k, rbm, v, validation_v, snapshots, refresh_epochs, results):
+    """
+    train layer k of a pipelined stack, in its own process, on hidden samples of the latest snapshots of layers 0..k-1
+    :param validation_v: propagated through the snapshots of the lower layers again at each refresh, so that the
+        validation MAE of an upper layer is measured on the representation it currently trains on
+    :param snapshots: multiprocessing.Manager().dict(), layer index -> params, published every refresh_epochs steps
+    :param results: multiprocessing.Queue, receives (k, params) once the layer is trained, or (k, Exception) carrying
+        the traceback if training failed
+    """
+    try:
+        while any(j not in snapshots for j in range(k)):
+            time.sleep(1.0)
+        lower = [snapshots[j] for j in range(k)]
+
+        def propagate(x, layers):
+            for params in layers:
+                x = RBM.sample_h_given_v(x, params['W'], params['c'])
+            return x
+
+        layer_validation_v = None
+        if validation_v is not None:
+            layer_validation_v = np.array(propagate(validation_v, lower), dtype=np.float32)
+
+        def batches():
+            i = 0
+            for batch_v in iterate_dataset(v, None, rbm.batch_size, seed=k):
+                if k > 0 and i > 0 and i % refresh_epochs == 0:
+                    lower[:] = [snapshots[j] for j in range(k)]
+                    if layer_validation_v is not None:
+                        # in place, the probe of fit_batches holds this array. the RBMs of pretrain_rbm_layers probe
+                        # synchronously, between two batches
+                        layer_validation_v[...] = propagate(validation_v, lower)
+                i += 1
+                yield propagate(batch_v, lower)
+
+        def publish(step, params):
+            snapshots[k] = params
+
+        print '### pretraining RBM Layer {i}, pipelined'.format(i=k)
+        rbm.fit_batches(batches(), layer_validation_v, snapshot_epochs=refresh_epochs, on_snapshot=publish)
+        snapshots[k] = rbm.params
+        results.put((k, rbm.params))
+    except Exception:
+        # the exit code stays 0, a non-zero one means the process died without reporting
+        results.put((k, Exception(traceback.format_exc())))
+
+
+def pretrain_rbm_layers(v, validation_v=None, n_hidden=[], gibbs_steps=[], batch_size=[], num_epochs=[], learning_rate=[], probe_epochs=[], cache_dir=None, pipelined=False, refresh_epochs=100):
+    """
+    :param v: 2d np.ndarray or PackedBinaryDataset, a packed input is propagated packed through the layers
+    :param cache_dir: if given, every trained layer is stored under cache_dir along with its memory-mapped hidden
+        outputs, keyed by the fingerprint of its input and its hyperparameters (n_hidden, gibbs_steps, learning_rate,
+        num_epochs, batch_size), so that a rerun loads the unchanged prefix of the stack instead of retraining it
+    :param pipelined: if True, every layer trains in its own process from the start, layer i+1 on hidden samples of
+        snapshots of layers 0..i that they publish every refresh_epochs steps, instead of waiting for layer i to finish
+        and transform the whole training set. the processes are forked, so no tf.Session should be open beforehand
+    :param refresh_epochs: steps between two snapshots of a layer, and between two refreshes of the snapshots an upper
+        layer samples from
+    """
     rbm_layers = []
     n_rbm = len(n_hidden)
     # create rbm layers
+    n_visible = v.shape[1]
     for i in range(n_rbm):
-        rbm = RBM(n_hidden=n_hidden[i],
+        rbm = RBM(n_visible=n_visible,
+                    n_hidden=n_hidden[i],
                     gibbs_steps=gibbs_steps[i],
                     batch_size=batch_size[i],
                     num_epochs=num_epochs[i],
                     learning_rate=learning_rate[i],
                     probe_epochs=probe_epochs[i])
         rbm_layers.append(rbm)
+        n_visible = n_hidden[i]
+    if pipelined:
+        if cache_dir is not None:
+            raise Exception("cache_dir is not supported by the pipelined pretraining")
+        manager = multiprocessing.Manager()
+        snapshots = manager.dict()
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=pipeline_worker, args=(i, rbm, v, validation_v, snapshots, refresh_epochs, results))
+                   for rbm, i in zip(rbm_layers, range(n_rbm))]
+        for worker in workers:
+            worker.start()
+        try:
+            pending = set(range(n_rbm))
+            while len(pending) > 0:
+                try:
+                    k, params = results.get(timeout=5.0)
+                except Queue.Empty:
+                    for k in pending:
+                        if workers[k].exitcode not in (None, 0):
+                            raise Exception("pipelined pretraining of RBM layer {k} died with exit code {c}".format(k=k, c=workers[k].exitcode))
+                    continue
+                if isinstance(params, Exception):
+                    raise Exception("pipelined pretraining of RBM layer {k} failed:\n{e}".format(k=k, e=params))
+                rbm_layers[k].params = params
+                pending.remove(k)
+        finally:
+            # the layers above a failed one wait for its snapshots forever
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            manager.shutdown()
+        return rbm_layers
     # pretrain rbm layers
     input = v
     validation_input = validation_v
+    if cache_dir is not None:
+        input_key = fingerprint(v)
+        validation_key = fingerprint(validation_v)
     for rbm, i in zip(rbm_layers, range(len(rbm_layers))):
+        if cache_dir is not None:
+            # the outputs of a layer are identified by the key of the layer
+            input_key = layer_cache_key(input_key, validation_key, rbm)
+            validation_key = input_key
+            path = os.path.join(cache_dir, input_key)
+            if os.path.isdir(path):
+                print '### loading RBM Layer {i} from {p}'.format(i=i, p=path)
+                output, validation_output = load_layer(path, rbm)
+                input = output
+                validation_input = validation_output
+                continue
         print '### pretraining RBM Layer {i}'.format(i=i)
         rbm.fit(input, validation_input)
-        output = rbm.sample_h_given_v(input, rbm.params['W'], rbm.params['c'])
+        output = sample_hidden(rbm, input)
         if validation_input is not None:
-            validation_output = rbm.sample_h_given_v(validation_input, rbm.params['W'], rbm.params['c'])
+            validation_output = sample_hidden(rbm, validation_input)
         else:
             validation_output = None
+        if cache_dir is not None:
+            save_layer(path, rbm, output, validation_output)
         input = output
         validation_input = validation_output
     return rbm_layers
     
+def random_rbm_layers(n_visible, n_hidden=[]):
+    """
+    rbm layers with random weights in place of pretrained ones, the no-pretraining baseline
+    :param n_visible: input dimension
+    :param n_hidden: list of the sizes of the layers
+    :return: list of RBM
+    """
+    rbm_layers = []
+    n_v = n_visible
+    for n_h in n_hidden:
+        rbm = RBM(n_visible=n_v, n_hidden=n_h)
+        rbm.params['W'] = np.float32(np.random.uniform(
+            low=-4 * np.sqrt(6.0 / (n_h + n_v)),
+            high=4 * np.sqrt(6.0 / (n_h + n_v)),
+            size=(n_v, n_h)
+        ))
+        rbm.params['b'] = np.zeros((n_v, ), np.float32)
+        rbm.params['c'] = np.zeros((n_h, ), np.float32)
+        rbm_layers.append(rbm)
+        n_v = n_h
+    return rbm_layers
+
+    
 def test_dbn():
     pass
     
@@ -146,7 +425,7 @@ if __name__ == "__main__":
     plt.close('all')
     np.random.seed(1)
     mnist = input_data.read_data_sets("MNIST_data/", one_hot=False)
-    train_x = np.float32(mnist.train.images > 0)
+    train_x = PackedBinaryDataset.from_dense(mnist.train.images > 0)
     train_y = mnist.train.labels
     validation_x = np.float32(mnist.validation.images[np.random.permutation(mnist.validation.images.shape[0])][0:1000] > 0)
 
@@ -156,6 +435,7 @@ if __name__ == "__main__":
     batch_size = [50] * len(n_hidden)
     num_epochs = [2000] * len(n_hidden)
     probe_epochs = [100] * len(n_hidden)
+    tic = time.time()
     rbm_layers = pretrain_rbm_layers(train_x,
                                      validation_x,
                                      n_hidden=n_hidden,
@@ -163,7 +443,9 @@ if __name__ == "__main__":
                                      batch_size=batch_size,
                                      num_epochs=num_epochs,
                                      learning_rate=learning_rate,
-                                     probe_epochs=probe_epochs)
+                                     probe_epochs=probe_epochs,
+                                     cache_dir='rbm_cache')
+    print 'pretraining took {t:.1f}s'.format(t=time.time() - tic)
 
     dbn = DBN(rbm_layers=rbm_layers,
               n_visible=28*28,
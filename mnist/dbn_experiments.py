@@ -0,0 +1,187 @@
+# coding=utf-8
+import time
+import Queue
+import ctypes
+import traceback
+import multiprocessing
+import multiprocessing.sharedctypes
+import numpy as np
+from tensorflow.examples.tutorials.mnist import input_data
+
+from util import PackedBinaryDataset
+from dbn import DBN, pretrain_rbm_layers, random_rbm_layers
+
+VARIANTS = ('finetune', 'no_finetune', 'no_pretrain')
+
+
+def shared_array(x):
+    """
+    copy x into shared memory, so that processes forked afterwards read the same pages
+    :param x: np.ndarray
+    :return: np.ndarray of the dtype and shape of x, backed by a multiprocessing RawArray
+    """
+    buf = multiprocessing.sharedctypes.RawArray(ctypes.c_uint8, x.nbytes)
+    y = np.frombuffer(buf, dtype=x.dtype).reshape(x.shape)
+    y[...] = x
+    return y
+
+
+def load_data(shared=False):
+    """
+    load and binarize MNIST once for all the variants, the images bit-packed
+    :param shared: if True, the arrays are placed in shared memory, see shared_array
+    :return: dict of train_x, train_y, validation_x, test_x, test_y
+    """
+    np.random.seed(1)
+    mnist = input_data.read_data_sets("MNIST_data/", one_hot=False)
+    train_x = PackedBinaryDataset.from_dense(mnist.train.images > 0)
+    test_x = PackedBinaryDataset.from_dense(mnist.test.images > 0)
+    data = dict(train_x=train_x.packed,
+                train_y=mnist.train.labels,
+                validation_x=np.float32(mnist.validation.images[np.random.permutation(mnist.validation.images.shape[0])][0:1000] > 0),
+                test_x=test_x.packed,
+                test_y=mnist.test.labels)
+    if shared:
+        data = dict([(k, shared_array(v)) for k, v in data.iteritems()])
+    data['train_x'] = PackedBinaryDataset(data['train_x'], train_x.n_columns)
+    data['test_x'] = PackedBinaryDataset(data['test_x'], test_x.n_columns)
+    return data
+
+
+def pretrain(data, rbm_config, cache_dir=None, queue=None):
+    """
+    pretrain the rbm stack once
+    :param queue: multiprocessing.Queue, if given ('pretrain', result) is put on it instead of returning the result,
+        or ('pretrain', Exception) carrying the traceback on failure, so that the pretraining can run in a child
+        process and keep the parent free of tf sessions before it forks the variants
+    :return: (rbm_layers, pretraining time)
+    """
+    try:
+        t0 = time.time()
+        rbm_layers = pretrain_rbm_layers(data['train_x'], data['validation_x'], cache_dir=cache_dir, **rbm_config)
+        result = (rbm_layers, time.time() - t0)
+    except Exception:
+        if queue is None:
+            raise
+        queue.put(('pretrain', Exception(traceback.format_exc())))
+        return
+    if queue is None:
+        return result
+    queue.put(('pretrain', result))
+
+
+def run_variant(variant, data, rbm_layers, dbn_config, queue=None):
+    """
+    finetune and evaluate one variant
+    :param variant: 'finetune', 'no_finetune' (rbm layers frozen) or 'no_pretrain' (random rbm layers)
+    :param rbm_layers: the pretrained stack, only its sizes are used by 'no_pretrain'
+    :param queue: multiprocessing.Queue, see pretrain, the key being the variant
+    :return: (variant, accuracy, finetuning time)
+    """
+    try:
+        if variant not in VARIANTS:
+            raise Exception("unknown variant {v}".format(v=variant))
+        print '### variant {v}'.format(v=variant)
+        np.random.seed(1)
+        if variant == 'no_pretrain':
+            rbm_layers = random_rbm_layers(data['train_x'].shape[1], [rbm.n_hidden for rbm in rbm_layers])
+        t0 = time.time()
+        dbn = DBN(rbm_layers=rbm_layers,
+                  n_visible=data['train_x'].shape[1],
+                  num_classes=10,
+                  finetune_rbm=variant != 'no_finetune',
+                  **dbn_config)
+        dbn.fit(data['train_x'], data['train_y'])
+        elapsed = time.time() - t0
+        accuracy = np.mean(dbn.predict(data['test_x']) == data['test_y'])
+        result = (variant, accuracy, elapsed)
+    except Exception:
+        if queue is None:
+            raise
+        queue.put((variant, Exception(traceback.format_exc())))
+        return
+    if queue is None:
+        return result
+    queue.put((variant, result))
+
+
+def wait_for_workers(workers, queue):
+    """
+    collect the results of child processes, as pretrain_rbm_layers does for its pipelined layers: a failure reported
+    by a child, or a child dying without reporting (e.g. killed for lack of memory), raises instead of waiting forever
+    :param workers: dict, key -> started multiprocessing.Process, which puts (key, result) or (key, Exception) on queue
+    :param queue: multiprocessing.Queue
+    :return: dict, key -> result
+    """
+    results = {}
+    try:
+        while len(results) < len(workers):
+            try:
+                key, result = queue.get(timeout=5.0)
+            except Queue.Empty:
+                for key, worker in workers.iteritems():
+                    if key not in results and worker.exitcode not in (None, 0):
+                        raise Exception("{k} died with exit code {c}".format(k=key, c=worker.exitcode))
+                continue
+            if isinstance(result, Exception):
+                raise Exception("{k} failed:\n{e}".format(k=key, e=result))
+            results[key] = result
+    finally:
+        for worker in workers.itervalues():
+            if len(results) < len(workers) and worker.is_alive():
+                worker.terminate()
+            worker.join()
+    return results
+
+
+def run_experiments(variants=VARIANTS, parallel=False, cache_dir=None, rbm_config=None, dbn_config=None):
+    """
+    load the data and pretrain the rbm stack once, then branch into the variants and print one comparison table
+    :param variants: subset of VARIANTS
+    :param parallel: if True, the variants run in parallel processes reading the data from shared memory
+    :param cache_dir: see pretrain_rbm_layers
+    :param rbm_config: keyword arguments of pretrain_rbm_layers, a [500, 500] stack if None
+    :param dbn_config: keyword arguments of DBN, learning_rate, batch_size, num_epochs and probe_epochs
+    :return: list of (variant, accuracy, wall time)
+    """
+    if rbm_config is None:
+        rbm_config = dict(n_hidden=[500, 500], gibbs_steps=[10] * 2, batch_size=[50] * 2, num_epochs=[2000] * 2,
+                          learning_rate=[1e-3] * 2, probe_epochs=[100] * 2)
+    if dbn_config is None:
+        dbn_config = dict(learning_rate=1e-3, batch_size=50, num_epochs=10000, probe_epochs=100)
+    data = load_data(shared=parallel)
+    pretrain_time = 0.0
+    if any(variant != 'no_pretrain' for variant in variants):
+        if parallel:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=pretrain, args=(data, rbm_config, cache_dir, queue))
+            p.start()
+            rbm_layers, pretrain_time = wait_for_workers({'pretrain': p}, queue)['pretrain']
+        else:
+            rbm_layers, pretrain_time = pretrain(data, rbm_config, cache_dir)
+    else:
+        rbm_layers = random_rbm_layers(data['train_x'].shape[1], rbm_config['n_hidden'])
+    if parallel:
+        queue = multiprocessing.Queue()
+        workers = dict([(variant, multiprocessing.Process(target=run_variant, args=(variant, data, rbm_layers, dbn_config, queue)))
+                        for variant in variants])
+        for worker in workers.itervalues():
+            worker.start()
+        finished = wait_for_workers(workers, queue)
+        results = [finished[variant] for variant in variants]
+    else:
+        results = [run_variant(variant, data, rbm_layers, dbn_config) for variant in variants]
+    if parallel:
+        print 'the variants finetuned at the same time on shared cores, their times are longer than those of a run alone'
+    print '{v:>12} {a:>10} {p:>14} {f:>14} {t:>14}'.format(v='variant', a='accuracy', p='pretrain (s)', f='finetune (s)', t='total (s)')
+    table = []
+    for variant, accuracy, finetune_time in results:
+        variant_pretrain_time = 0.0 if variant == 'no_pretrain' else pretrain_time
+        table.append((variant, accuracy, variant_pretrain_time + finetune_time))
+        print '{v:>12} {a:>9.2f}% {p:>14.1f} {f:>14.1f} {t:>14.1f}'.format(v=variant, a=accuracy * 100.0, p=variant_pretrain_time,
+                                                                          f=finetune_time, t=variant_pretrain_time + finetune_time)
+    return table
+
+
+if __name__ == "__main__":
+    run_experiments(parallel=True, cache_dir='rbm_cache')
@@ -1,169 +1,322 @@
 # coding=utf-8
+import os
+import time
+import threading
+import zlib
+import hashlib
 import numpy as np
+import scipy.sparse
 import tensorflow as tf
-import cPickle
+from array import array
 from tensorflow.examples.tutorials.mnist import input_data
 
-class Struct(dict):
-    def __init__(self, **kwargs):
-        super(Struct, self).__init__(**kwargs)
-        self.__dict__ = self
+from util import Struct, GraphWrapper
+from runtime import RUNTIME, new_token
+from model_io import save_params, load_params
 
-
-class GraphWrapper(object):
-    def __init__(self, graph, phr, var, tsr, ops):
-        self.graph = graph
-        self.phr = phr
-        self.var = var
-        self.tsr = tsr
-        self.ops = ops
+# default learning rate of FactorMach.fit, keyed by sparse mode: Adam for dense inputs, Adagrad for sparse ones
+DEFAULT_LEARNING_RATE = {False: 1e-3, True: 1e-1}
 
 
 class FactorMach(object):
     def __init__(self):
         # 模型的参数,对应于Graph中的trainable variables
         self.params = {}
-        # Graph and session for online running
-        self.updated = False
-        self.G_run = None
-        self.sess_run = None
-        
-    def __del__(self):
-        if self.sess_run is not None:
-            self.sess_run.close()
-
-    def __build_graph__(self, input_dim=None, latent_dim=None, var_val=None):
+        # identifies the current params to the shared runtime, see runtime.new_token
+        self.token = None
+        # params prepared for the numpy backend, rebuilt after params change
+        self.np_run = None
+
+    def __runtime__(self, input_dim, latent_dim, sparse):
+        """
+        :return: runtime.RuntimeEntry of the graph of this architecture, built on the first call only
+        """
+        return RUNTIME.get(('fm', input_dim, latent_dim, sparse), lambda: self.__build_graph__(input_dim, latent_dim, sparse=sparse))
+
+    def __build_graph__(self, input_dim, latent_dim, sparse=False):
+        """
+        :param sparse: if True, the instances are fed as (row_ids, feat_ids, feat_vals) triplets of the non-zeros,
+            only the touched rows of w and V are gathered, and they are updated by Adagrad, whose sparse update
+            leaves the untouched rows alone (the slots of Adam are decayed densely on every step)
+        """
         graph = tf.Graph()
         with graph.as_default():
-            if var_val is not None:
-                input_dim = var_val['V'].shape[0]
-                latent_dim = var_val['V'].shape[1]
-                w0 = tf.Variable(var_val['w0'])
-                w = tf.Variable(var_val['w'])
-                V = tf.Variable(var_val['V'])
-            else:
-                w0 = tf.Variable(0.0)
-                w = tf.Variable(tf.truncated_normal([input_dim, 1], stddev=1.0/np.sqrt(input_dim), seed=0))
-                V = tf.Variable(tf.truncated_normal([input_dim, latent_dim], stddev=1.0/np.sqrt(input_dim), seed=1))
-            X = tf.placeholder(tf.float32, (None, input_dim))
-            XXT = tf.placeholder(tf.float32, (None, input_dim * input_dim))
+            w0 = tf.Variable(0.0)
+            w = tf.Variable(tf.truncated_normal([input_dim, 1], stddev=1.0/np.sqrt(input_dim), seed=0))
+            V = tf.Variable(tf.truncated_normal([input_dim, latent_dim], stddev=1.0/np.sqrt(input_dim), seed=1))
             y_ = tf.placeholder(tf.float32, (None,))
             learning_rate = tf.placeholder(tf.float32)
             penalty_w = tf.placeholder(tf.float32)
             penalty_V = tf.placeholder(tf.float32)
-            VVT = tf.matmul(V, V, transpose_a=False, transpose_b=True)
-            # drop the diagnal elements, method 1
-            #VVT_ = VVT - tf.diag(tf.reduce_sum(V**2, 1))
-            # drop the diagnal elements, method 2
-            diag_off = tf.ones([input_dim, input_dim], tf.float32) - tf.diag(tf.ones([input_dim], tf.float32))
-            VVT_ = VVT * diag_off
-            y = w0 + tf.matmul(X, w) + tf.matmul(XXT, tf.reshape(VVT_, [-1, 1]))
-            y = tf.reshape(y, [-1])
+            if sparse:
+                row_ids = tf.placeholder(tf.int32, (None,))
+                feat_ids = tf.placeholder(tf.int32, (None,))
+                feat_vals = tf.placeholder(tf.float32, (None,))
+                num_rows = tf.placeholder(tf.int32, ())
+                w_nz = tf.reshape(tf.gather(w, feat_ids), [-1])
+                V_nz = tf.gather(V, feat_ids)
+                xV_nz = V_nz * tf.reshape(feat_vals, [-1, 1])
+                # same identity as the dense path below, summed over the non-zeros of each row
+                XV = tf.unsorted_segment_sum(xV_nz, row_ids, num_rows)
+                X2V2 = tf.unsorted_segment_sum(xV_nz * xV_nz, row_ids, num_rows)
+                pairwise = tf.reduce_sum(XV * XV - X2V2, reduction_indices=1)
+                y = w0 + tf.unsorted_segment_sum(w_nz * feat_vals, row_ids, num_rows) + pairwise
+                # only the rows touched by the batch are penalised
+                reg_V = tf.reduce_sum(V_nz * V_nz)
+                reg_w = tf.reduce_sum(w_nz * w_nz)
+                phr = Struct(row_ids=row_ids, feat_ids=feat_ids, feat_vals=feat_vals, num_rows=num_rows,
+                             y_=y_, learning_rate=learning_rate, penalty_w=penalty_w, penalty_V=penalty_V)
+            else:
+                X = tf.placeholder(tf.float32, (None, input_dim))
+                # sum_{i!=j} <v_i, v_j> x_i x_j = sum_f [(sum_i v_if x_i)^2 - sum_i v_if^2 x_i^2],
+                # i.e. twice the usual 0.5 * sum_f [...] identity, which matches the scale of the former
+                # XXT * VVT formulation. costs O(input_dim * latent_dim) per instance instead of O(input_dim^2)
+                XV = tf.matmul(X, V)
+                X2V2 = tf.matmul(X * X, V * V)
+                pairwise = tf.reduce_sum(XV * XV - X2V2, reduction_indices=1)
+                y = w0 + tf.reshape(tf.matmul(X, w), [-1]) + pairwise
+                reg_V = tf.reduce_sum(V * V)
+                reg_w = tf.reduce_sum(w * w)
+                phr = Struct(X=X, y_=y_, learning_rate=learning_rate, penalty_w=penalty_w, penalty_V=penalty_V)
             nll = -tf.reduce_mean(tf.log(tf.nn.sigmoid(y * y_)))
-            reg_V = tf.reduce_sum(V * V)
-            reg_w = tf.reduce_sum(w * w)
             loss = nll + penalty_w * reg_w + penalty_V * reg_V
-            train_step = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+            if sparse:
+                train_step = tf.train.AdagradOptimizer(learning_rate).minimize(loss)
+            else:
+                train_step = tf.train.AdamOptimizer(learning_rate).minimize(loss)
             is_correct = tf.greater(y * y_, 0)
             accuracy = tf.reduce_mean(tf.cast(is_correct, tf.float32))
             init_vars = tf.initialize_all_variables()
-        phr = Struct(X=X, XXT=XXT, y_=y_, learning_rate=learning_rate, penalty_w=penalty_w, penalty_V=penalty_V)
         var = Struct(w0=w0, w=w, V=V)
         tsr = Struct(y=y, nll=nll, accuracy=accuracy)
         ops = Struct(train_step=train_step, init_vars=init_vars)
         return GraphWrapper(graph, phr, var, tsr, ops)
 
-    def fit(self, x, y, latent_dim, batch_size, num_epochs, penalty_w=1e-2, penalty_V=1e-2, learning_rate=1e-3, decay_rate=None, decay_epochs=None, verbose=True, probe_epochs=100):
+    def fit(self, x, y, latent_dim, batch_size, num_epochs, penalty_w=1e-2, penalty_V=1e-2, learning_rate=None, decay_rate=None, decay_epochs=None, verbose=True, probe_epochs=100, num_workers=1):
         """
         train 2-way factorisation machine
-        :param x: 2d np.ndarray, each row stores an instance
+        :param x: 2d np.ndarray or scipy.sparse matrix (see load_libsvm), each row stores an instance
         :param y: 1d np.ndarray, {0, 1}
         :param latent_dim:
         :param batch_size:
         :param num_epochs:
         :param penalty_w:
         :param penalty_V: suggest firstly trying penalty_V = penalty_w / latent_dim
-        :param learning_rate:
+        :param learning_rate: DEFAULT_LEARNING_RATE of the mode if None: 1e-3 for dense x, trained by Adam, and 1e-1
+            for sparse x, trained by Adagrad, whose steps shrink with the accumulated squared gradients
         :param decay_rate:
         :param decay_epochs: decayed_learning_rate = learning_rate * np.power(decay_rate, int(i / decay_epochs))
         :param verbose:
         :param probe_epochs:
+        :param num_workers: number of threads running training steps concurrently on the shared w0, w and V, Hogwild
+            style: every thread draws its own batches and the optimizer applies updates without locking. num_epochs is
+            the total number of steps over all threads. session.run releases the GIL, so the threads do run in parallel
         :return:
         """
-        if not(isinstance(x, np.ndarray) and isinstance(y, np.ndarray)):
-            raise Exception("both x and y should np.ndarray")
+        if not((isinstance(x, np.ndarray) or scipy.sparse.issparse(x)) and isinstance(y, np.ndarray)):
+            raise Exception("x should be np.ndarray or scipy.sparse matrix, y should be np.ndarray")
+        sparse = scipy.sparse.issparse(x)
+        if sparse:
+            x = scipy.sparse.csr_matrix(x, dtype=np.float32)
+        if learning_rate is None:
+            learning_rate = DEFAULT_LEARNING_RATE[sparse]
         unique_labels = np.unique(y)
         if not (len(unique_labels) == 2 and unique_labels[0] == 0 and unique_labels[1] == 1):
             raise Exception("labels must be {0, 1}")
         y = 2 * y - 1
-        num_samples = x.shape[0]
         input_dim = x.shape[1]
-        G = self.__build_graph__(input_dim, latent_dim)
-        sess = tf.Session(graph=G.graph)
-        with sess.as_default():
-            np.random.seed(3)
-            G.ops.init_vars.run()
-            head = 0
-            indices = range(num_samples)
-            for i in range(num_epochs):
-                if head + batch_size > num_samples:
-                    indices = np.random.permutation(num_samples)
-                    head = 0
-                selected = indices[head: head + batch_size]
-                head += batch_size
-                batch_x = x[selected]
-                batch_xxt = self.__calc_XXT__(batch_x)
-                batch_y = y[selected]
-                if verbose and i % probe_epochs == 0:
-                    accuracy = G.tsr.accuracy.eval(feed_dict={G.phr.X: batch_x, G.phr.XXT: batch_xxt, G.phr.y_: batch_y})
-                    print 'epoch {s}, training batch, accuracy {a:.2f}%'.format(s=i, a=accuracy * 100.0)
-                if decay_rate is not None:
-                    decayed_learning_rate = learning_rate * np.power(decay_rate, int(i / decay_epochs))
-                    actual_learning_rate = decayed_learning_rate
-                    if verbose and i % decay_epochs == 0:
-                        print 'epoch {e}, learning_rate {l:.8f}'.format(e=i, l=actual_learning_rate)
+        entry = self.__runtime__(input_dim, latent_dim, sparse)
+        G = entry.G
+        with entry.training_session() as sess:
+            with sess.as_default():
+                np.random.seed(3)
+                if num_workers == 1:
+                    batches = self.__iterate_batches__(x, y, batch_size)
+                    self.__train__(G, sess, batches, num_epochs, penalty_w, penalty_V, learning_rate, decay_rate, decay_epochs, verbose, probe_epochs)
                 else:
-                    actual_learning_rate = learning_rate
-                G.ops.train_step.run(feed_dict={G.phr.X: batch_x, G.phr.XXT: batch_xxt, G.phr.y_: batch_y,
-                                                G.phr.learning_rate: actual_learning_rate,
-                                                G.phr.penalty_w: penalty_w, G.phr.penalty_V: penalty_V})
-            for k, v in G.var.iteritems():
-                self.params[k] = G.var[k].eval()
-        self.updated = True
+                    # every worker runs its share of the steps, with the decay schedule scaled accordingly
+                    worker_epochs = int(np.ceil(1.0 * num_epochs / num_workers))
+                    worker_decay_epochs = max(1, decay_epochs // num_workers) if decay_epochs is not None else None
+                    errors = []
+
+                    def run_worker(k):
+                        try:
+                            # an own, shuffled order per worker, so that the workers do not step through the same batches
+                            batches = self.__iterate_batches__(x, y, batch_size, rng=np.random.RandomState(3 + k))
+                            self.__train__(G, sess, batches, worker_epochs, penalty_w, penalty_V, learning_rate,
+                                           decay_rate, worker_decay_epochs, verbose and k == 0, probe_epochs)
+                        except Exception as e:
+                            errors.append(e)
+
+                    workers = [threading.Thread(target=run_worker, args=(k, )) for k in range(num_workers)]
+                    tic = time.time()
+                    for worker in workers:
+                        worker.start()
+                    for worker in workers:
+                        worker.join()
+                    if len(errors) > 0:
+                        raise errors[0]
+                    if verbose:
+                        num_trained = num_workers * worker_epochs * batch_size
+                        print '{w} workers, {t:.1f} samples/sec'.format(w=num_workers, t=num_trained / (time.time() - tic))
+            self.token = new_token()
+            self.params = entry.fetch(sess)
+        self.np_run = None
+
+    def fit_stream(self, shard_dir, latent_dim, batch_size, num_passes=1, buffer_size=10000, input_dim=None, penalty_w=1e-2, penalty_V=1e-2, learning_rate=None, decay_rate=None, decay_epochs=None, verbose=True, probe_epochs=100, zero_based=False):
+        """
+        train 2-way factorisation machine out of core, reading the batches from the shards in shard_dir, see iterate_shards.
+        resident memory is bounded by buffer_size rows whatever the size of the dataset
+        :param shard_dir:
+        :param latent_dim:
+        :param batch_size:
+        :param num_passes: number of passes over the whole dataset
+        :param buffer_size: number of rows held in the shuffle buffer
+        :param input_dim: required for libsvm shards, inferred from the first shard for npy shards
+        :param learning_rate: see fit, libsvm shards are trained in sparse mode
+        :param zero_based: of the indices of libsvm shards, one-based as in the standard format by default
+        :return:
+        """
+        shards = list_shards(shard_dir)
+        if len(shards) < 1:
+            raise Exception("no shard found in {d}".format(d=shard_dir))
+        sparse = shards[0][0] == 'libsvm'
+        if input_dim is None:
+            if sparse:
+                raise Exception("input_dim must be given for libsvm shards")
+            input_dim = np.load(shards[0][1], mmap_mode='r').shape[1]
+        if learning_rate is None:
+            learning_rate = DEFAULT_LEARNING_RATE[sparse]
+        entry = self.__runtime__(input_dim, latent_dim, sparse)
+        G = entry.G
+        with entry.training_session() as sess:
+            with sess.as_default():
+                np.random.seed(3)
+                batches = ((batch_x, 2 * batch_y - 1) for batch_x, batch_y in
+                           iterate_shards(shard_dir, batch_size, num_passes, buffer_size, input_dim, seed=3, zero_based=zero_based))
+                self.__train__(G, sess, batches, None, penalty_w, penalty_V, learning_rate, decay_rate, decay_epochs, verbose, probe_epochs)
+            self.token = new_token()
+            self.params = entry.fetch(sess)
+        self.np_run = None
+
+    def __iterate_batches__(self, x, y, batch_size, rng=None):
+        """
+        go through the dataset in random orders, the first pass in the original order unless rng is given
+        :param rng: np.random.RandomState, the global one if None. a given rng also shuffles the first pass, so that
+            iterators with differently seeded rngs start from different batches
+        """
+        num_samples = x.shape[0]
+        head = 0
+        if rng is None:
+            rng = np.random
+            indices = range(num_samples)
+        else:
+            indices = rng.permutation(num_samples)
+        while True:
+            if head + batch_size > num_samples:
+                indices = rng.permutation(num_samples)
+                head = 0
+            selected = indices[head: head + batch_size]
+            head += batch_size
+            yield x[selected], y[selected]
+
+    def __train__(self, G, sess, batches, num_epochs, penalty_w, penalty_V, learning_rate, decay_rate, decay_epochs, verbose, probe_epochs):
+        """
+        run the training steps, possibly from several threads sharing sess
+        :param G: GraphWrapper
+        :param sess: tf.Session, passed explicitly because the default session is thread-local
+        :param batches: iterator of (batch_x, batch_y), y in {-1, 1}
+        :param num_epochs: number of steps, or None to run until batches is exhausted
+        """
+        i = 0
+        num_seen = 0
+        tic = time.time()
+        for batch_x, batch_y in batches:
+            if num_epochs is not None and i >= num_epochs:
+                break
+            if verbose and i % probe_epochs == 0:
+                feed_dict = self.__feed_x__(G, batch_x)
+                feed_dict[G.phr.y_] = batch_y
+                accuracy = sess.run(G.tsr.accuracy, feed_dict=feed_dict)
+                toc = time.time()
+                throughput = num_seen / (toc - tic) if num_seen > 0 else 0.0
+                print 'epoch {s}, training batch, accuracy {a:.2f}%, {t:.1f} samples/sec'.format(s=i, a=accuracy * 100.0, t=throughput)
+                num_seen = 0
+                tic = toc
+            if decay_rate is not None:
+                decayed_learning_rate = learning_rate * np.power(decay_rate, int(i / decay_epochs))
+                actual_learning_rate = decayed_learning_rate
+                if verbose and i % decay_epochs == 0:
+                    print 'epoch {e}, learning_rate {l:.8f}'.format(e=i, l=actual_learning_rate)
+            else:
+                actual_learning_rate = learning_rate
+            feed_dict = self.__feed_x__(G, batch_x)
+            feed_dict.update({G.phr.y_: batch_y, G.phr.learning_rate: actual_learning_rate,
+                              G.phr.penalty_w: penalty_w, G.phr.penalty_V: penalty_V})
+            sess.run(G.ops.train_step, feed_dict=feed_dict)
+            num_seen += batch_x.shape[0]
+            i += 1
 
-    def predict(self, x):
+    def predict(self, x, backend='tf'):
         """
-        :param x: 2d np.ndarray, each row stores an instance
+        :param x: 2d np.ndarray or scipy.sparse matrix, each row stores an instance
+        :param backend: 'tf' runs the TensorFlow graph, 'numpy' scores straight from self.params without any session,
+            which avoids the graph build on the first call and the feed_dict overhead on every call
         :return: 1d np.ndarray, ideally giving positive numbers for positive instances and negative numbers vice versus
         """
         if len(self.params) < 1:
             raise Exception("empty model")
-        if self.updated:
-            self.G_run = self.__build_graph__(var_val=self.params)
-            if self.sess_run is not None: self.sess_run.close()
-            self.sess_run = tf.Session(graph=self.G_run.graph)
-            self.sess_run.run(self.G_run.ops.init_vars)
-            self.updated = False
+        if backend == 'numpy':
+            return self.__predict_numpy__(x)
+        elif backend != 'tf':
+            raise Exception("unknown backend {b}".format(b=backend))
+        sparse = scipy.sparse.issparse(x)
+        if sparse:
+            x = scipy.sparse.csr_matrix(x, dtype=np.float32)
+        entry = self.__runtime__(self.params['V'].shape[0], self.params['V'].shape[1], sparse)
         num_samples = x.shape[0]
         batch_size = 50
         predictions = np.zeros((num_samples, ), dtype=np.float32)
-        for i in range(0, int(np.ceil(1.0 * num_samples / batch_size))):
-            a = i * batch_size
-            b = min((i + 1) * batch_size, num_samples)
-            batch_x = x[a : b]
-            batch_xxt = self.__calc_XXT__(batch_x)
-            y = self.sess_run.run(self.G_run.tsr.y, feed_dict={self.G_run.phr.X: batch_x, self.G_run.phr.XXT: batch_xxt})
-            predictions[a: b] = y
+        with entry.session(self.params, self.token) as sess:
+            for i in range(0, int(np.ceil(1.0 * num_samples / batch_size))):
+                a = i * batch_size
+                b = min((i + 1) * batch_size, num_samples)
+                batch_x = x[a : b]
+                y = sess.run(entry.G.tsr.y, feed_dict=self.__feed_x__(entry.G, batch_x))
+                predictions[a: b] = y
         return predictions
 
-    def predict_proba(self, x):
+    def predict_proba(self, x, backend='tf'):
         """
         :param x:
+        :param backend: see predict
         :return: Nx2 np.ndarray, each row stores the probabilities of belonging to the negative and positive classes
         """
-        proba = self.__sigmoid__(self.predict(x))
+        proba = self.__sigmoid__(self.predict(x, backend))
         return np.stack((1 - proba, proba), axis=1)
 
+    def __predict_numpy__(self, x):
+        """
+        same scores as the graph, computed with the linear-time pairwise formula in numpy
+        :param x: 2d np.ndarray or scipy.sparse matrix
+        :return: 1d np.ndarray
+        """
+        if self.np_run is None:
+            V = np.asarray(self.params['V'], dtype=np.float32)
+            self.np_run = Struct(w0=np.float32(self.params['w0']),
+                                 w=np.asarray(self.params['w'], dtype=np.float32).reshape((-1)),
+                                 V=V, V2=V * V)
+        if scipy.sparse.issparse(x):
+            x = scipy.sparse.csr_matrix(x, dtype=np.float32)
+            X2 = x.multiply(x)
+        else:
+            x = np.asarray(x, dtype=np.float32)
+            X2 = x * x
+        XV = np.asarray(x.dot(self.np_run.V))
+        X2V2 = np.asarray(X2.dot(self.np_run.V2))
+        y = self.np_run.w0 + np.asarray(x.dot(self.np_run.w)).reshape((-1)) + (XV * XV - X2V2).sum(axis=1)
+        return np.float32(y)
+
     def __calc_loss__(self, x, y, sess, loss_tensor, graph):
         num_samples = x.shape[0]
         batch_size = 50
@@ -173,29 +326,278 @@ class FactorMach(object):
             a = i * batch_size
             b = min((i + 1) * batch_size, num_samples)
             batch_x = x[a : b]
-            batch_xxt = self.__calc_XXT__(batch_x)
             batch_y = y[a : b]
-            loss += sess.run(loss_tensor, feed_dict={graph.phr.X: batch_x, graph.phr.XXT: batch_xxt, graph.phr.y_: batch_y})
+            feed_dict = self.__feed_x__(graph, batch_x)
+            feed_dict[graph.phr.y_] = batch_y
+            loss += sess.run(loss_tensor, feed_dict=feed_dict)
         loss /= num_batches
         return loss
 
     def save(self, path):
+        """
+        :param path: directory, see model_io.save_params
+        """
         if len(self.params) < 1:
             raise Exception("empty model")
-        with open(path, "wb") as f:
-            cPickle.dump(self.params, f)
+        save_params(path, self.params)
 
-    def load(self, path):
-        with open(path, "rb") as f:
-            self.params = cPickle.load(f)
-        self.updated = True
+    def load(self, path, mmap=True):
+        """
+        :param path: directory written by save, or a file written by the former cPickle format
+        :param mmap: if True the params are memory-mapped, see model_io.load_params
+        """
+        self.params = load_params(path, mmap)
+        self.token = new_token()
+        self.np_run = None
+
+    def __feed_x__(self, G, batch_x):
+        """
+        :param G: GraphWrapper
+        :param batch_x: 2d np.ndarray or scipy.sparse.csr_matrix, matching the mode G was built in
+        :return: feed_dict of the input placeholders
+        """
+        if 'X' in G.phr:
+            return {G.phr.X: batch_x}
+        coo = batch_x.tocoo()
+        return {G.phr.row_ids: coo.row, G.phr.feat_ids: coo.col, G.phr.feat_vals: coo.data, G.phr.num_rows: coo.shape[0]}
 
-    def __calc_XXT__(self, X):
-        return np.apply_along_axis(lambda x: np.outer(x, x).reshape((-1)), 1, X)
-    
     def __sigmoid__(self, x):
         return 1.0 / (1 + np.power(np.e, -x))
 
+
+class FeatureHasher(object):
+    def __init__(self, num_buckets, signed=True):
+        """
+        hashing trick: map arbitrary features into num_buckets columns, so that the size of w and V, and the optimizer
+        slots along with them, stays fixed however large the raw vocabulary grows
+        :param num_buckets: input_dim of the FactorMach trained on the hashed features
+        :param signed: if True, each feature is given a sign from a second hash, so that colliding features cancel out
+            in expectation instead of piling up
+        """
+        self.num_buckets = num_buckets
+        self.signed = signed
+
+    def hash_feature(self, key):
+        """
+        :param key: str or unicode
+        :return: (bucket, sign)
+        """
+        key = self.__to_bytes__(key)
+        bucket = (zlib.crc32(key) & 0xffffffff) % self.num_buckets
+        sign = 1.0
+        # the sign comes from a hash independent of the bucket one: crc32 is affine, a salted crc32 would tie the sign
+        # to the low bits of the bucket, and adler32 sums the bytes, giving the same sign to every anagram
+        if self.signed and ord(hashlib.md5(key).digest()[0]) & 1:
+            sign = -1.0
+        return bucket, sign
+
+    def __to_bytes__(self, s):
+        """
+        :param s: str, taken as bytes already, unicode, encoded in utf-8, or anything else, through str
+        :return: str
+        """
+        if isinstance(s, unicode):
+            return s.encode('utf-8')
+        if not isinstance(s, str):
+            return str(s)
+        return s
+
+    def transform_one(self, record):
+        """
+        :param record: dict or iterable. in a dict, string values are categorical, hashed as "name=value" with weight 1,
+            and numeric values are hashed as "name" with the value as weight. an iterable gives features of weight 1
+        :return: (indices, values), 1d np.ndarray of int32 and float32, colliding features are summed
+        """
+        if isinstance(record, dict):
+            items = []
+            for name, value in record.iteritems():
+                if isinstance(value, basestring):
+                    # built as bytes, so that non-ascii byte strings are not decoded as ascii
+                    items.append((self.__to_bytes__(name) + '=' + self.__to_bytes__(value), 1.0))
+                else:
+                    items.append((name, float(value)))
+        else:
+            items = [(key, 1.0) for key in record]
+        row = {}
+        for key, value in items:
+            bucket, sign = self.hash_feature(key)
+            row[bucket] = row.get(bucket, 0.0) + sign * value
+        indices = np.array(sorted(row.keys()), dtype=np.int32)
+        values = np.array([row[k] for k in indices], dtype=np.float32)
+        return indices, values
+
+    def transform(self, records):
+        """
+        :param records: list of records, see transform_one
+        :return: scipy.sparse.csr_matrix of float32, (len(records), num_buckets), to be fed to FactorMach.fit/predict
+        """
+        rows = [self.transform_one(record) for record in records]
+        indptr = np.cumsum([0] + [len(indices) for indices, _ in rows])
+        if len(rows) > 0:
+            indices = np.concatenate([indices for indices, _ in rows])
+            values = np.concatenate([values for _, values in rows])
+        else:
+            indices = np.zeros((0,), dtype=np.int32)
+            values = np.zeros((0,), dtype=np.float32)
+        return scipy.sparse.csr_matrix((values, indices, indptr), shape=(len(rows), self.num_buckets))
+
+
+def parse_libsvm_line(line, zero_based=False):
+    """
+    :param line: "label index:value index:value ..."
+    :param zero_based: if False the indices are one-based, as in the standard libsvm/svmlight format, and shifted down
+    :return: (label, indices, values), label in {0, 1} with positive labels mapped to 1, zero-based indices, or None for
+        blank/comment lines
+    """
+    line = line.split('#', 1)[0].split()
+    if len(line) == 0:
+        return None
+    indices = np.empty((len(line) - 1,), dtype=np.int32)
+    values = np.empty((len(line) - 1,), dtype=np.float32)
+    offset = 0 if zero_based else 1
+    for j, item in enumerate(line[1:]):
+        k, v = item.split(':')
+        indices[j] = int(k) - offset
+        values[j] = float(v)
+        if indices[j] < 0:
+            raise Exception("feature index {k} below {o}, are the indices zero-based?".format(k=k, o=offset))
+    return float(float(line[0]) > 0), indices, values
+
+
+def load_libsvm(path, input_dim=None, zero_based=False):
+    """
+    read a libsvm/svmlight file, "label index:value index:value ..."
+    :param path:
+    :param input_dim: number of features, inferred from the largest index if None
+    :param zero_based: see parse_libsvm_line
+    :return: (x, y), x is a scipy.sparse.csr_matrix of float32, y is 1d np.ndarray of {0, 1}, positive labels mapped to 1
+    """
+    labels = array('f')
+    indptr = array('l', [0])
+    indices = array('i')
+    data = array('f')
+    with open(path, 'r') as f:
+        for line in f:
+            parsed = parse_libsvm_line(line, zero_based)
+            if parsed is None:
+                continue
+            labels.append(parsed[0])
+            indices.extend(parsed[1].tolist())
+            data.extend(parsed[2].tolist())
+            indptr.append(len(indices))
+    # array('i') holds C ints, whose size np.intc matches on every platform
+    indices = np.frombuffer(indices, dtype=np.intc).astype(np.int32)
+    if input_dim is None:
+        input_dim = indices.max() + 1 if len(indices) > 0 else 0
+    check_feature_indices(indices, input_dim, path)
+    x = scipy.sparse.csr_matrix((np.frombuffer(data, dtype=np.float32), indices, np.fromiter(indptr, dtype=np.int64, count=len(indptr))),
+                                shape=(len(labels), input_dim))
+    return x, np.frombuffer(labels, dtype=np.float32).copy()
+
+
+def check_feature_indices(indices, input_dim, source):
+    """
+    raise if a zero-based feature index does not fit input_dim, rather than let it index past w and V
+    """
+    if len(indices) > 0 and indices.max() >= input_dim:
+        raise Exception("feature index {k} of {s} out of range for input_dim {d} (zero-based)".format(
+            k=indices.max(), s=source, d=input_dim))
+
+
+def list_shards(shard_dir):
+    """
+    the shards of a dataset are either pairs of npy files, <name>.x.npy (2d float32) and <name>.y.npy (1d {0, 1}),
+    or libsvm files, <name>.libsvm or <name>.svm. a directory should not mix both kinds
+    :param shard_dir:
+    :return: list of (kind, x_path, y_path) sorted by name, kind being 'npy' or 'libsvm', y_path None for libsvm
+    """
+    shards = []
+    for name in sorted(os.listdir(shard_dir)):
+        path = os.path.join(shard_dir, name)
+        if name.endswith('.x.npy'):
+            shards.append(('npy', path, path[:-len('.x.npy')] + '.y.npy'))
+        elif name.endswith('.libsvm') or name.endswith('.svm'):
+            shards.append(('libsvm', path, None))
+    if len(set(kind for kind, _, _ in shards)) > 1:
+        raise Exception("{d} mixes npy and libsvm shards".format(d=shard_dir))
+    return shards
+
+
+def iterate_shard_rows(shard, chunk_size=1024, zero_based=False):
+    """
+    read the rows of a shard one by one, the npy files are memory-mapped and copied chunk_size rows at a time
+    :param shard: (kind, x_path, y_path) from list_shards
+    :param zero_based: of the indices of libsvm shards, see parse_libsvm_line
+    :return: iterator of (row, label), row is a 1d np.ndarray owning its data for npy shards, so that a row held in
+        the shuffle buffer does not keep its chunk alive, and (indices, values) for libsvm shards
+    """
+    kind, x_path, y_path = shard
+    if kind == 'npy':
+        x = np.load(x_path, mmap_mode='r')
+        y = np.load(y_path, mmap_mode='r')
+        for a in range(0, x.shape[0], chunk_size):
+            chunk_x = np.array(x[a: a + chunk_size], dtype=np.float32)
+            chunk_y = np.array(y[a: a + chunk_size], dtype=np.float32)
+            for row, label in zip(chunk_x, chunk_y):
+                yield row.copy(), label
+    else:
+        with open(x_path, 'r') as f:
+            for line in f:
+                parsed = parse_libsvm_line(line, zero_based)
+                if parsed is not None:
+                    yield (parsed[1], parsed[2]), parsed[0]
+
+
+def iterate_shards(shard_dir, batch_size, num_passes=1, buffer_size=10000, input_dim=None, seed=None, zero_based=False):
+    """
+    stream shuffled batches from the shards in shard_dir, see list_shards. the shards are visited in a random order on
+    each pass and the rows go through a shuffle buffer of buffer_size rows, so memory does not grow with the dataset
+    :param shard_dir:
+    :param batch_size:
+    :param num_passes:
+    :param buffer_size:
+    :param input_dim: number of columns of the sparse batches, required for libsvm shards
+    :param seed:
+    :param zero_based: of the indices of libsvm shards, see parse_libsvm_line
+    :return: iterator of (batch_x, batch_y), batch_x is 2d np.ndarray or scipy.sparse.csr_matrix, batch_y in {0, 1}
+    """
+    shards = list_shards(shard_dir)
+    rng = np.random.RandomState(seed)
+
+    def stack(rows):
+        labels = np.array([label for _, label in rows], dtype=np.float32)
+        if shards[0][0] == 'npy':
+            return np.stack([row for row, _ in rows]), labels
+        indptr = np.cumsum([0] + [len(row[0]) for row, _ in rows])
+        indices = np.concatenate([row[0] for row, _ in rows])
+        check_feature_indices(indices, input_dim, shard_dir)
+        values = np.concatenate([row[1] for row, _ in rows])
+        return scipy.sparse.csr_matrix((values, indices, indptr), shape=(len(rows), input_dim)), labels
+
+    buffer = []
+    batch = []
+    for p in range(num_passes):
+        for k in rng.permutation(len(shards)):
+            for item in iterate_shard_rows(shards[k], zero_based=zero_based):
+                if len(buffer) < buffer_size:
+                    buffer.append(item)
+                    continue
+                j = rng.randint(buffer_size)
+                batch.append(buffer[j])
+                buffer[j] = item
+                if len(batch) == batch_size:
+                    yield stack(batch)
+                    batch = []
+    rng.shuffle(buffer)
+    for item in buffer:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield stack(batch)
+            batch = []
+    if len(batch) > 0:
+        yield stack(batch)
+
+
 if __name__ == '__main__':
     digit1 = 5
     digit2 = 6
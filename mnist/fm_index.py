@@ -0,0 +1,133 @@
+# coding=utf-8
+import numpy as np
+import scipy.sparse
+
+
+def fm_parts(x, params):
+    """
+    split the FactorMach score of the rows of x into what does not depend on the other side and the latent vector
+    :param x: 2d np.ndarray or scipy.sparse matrix, only the context (or only the item) features set
+    :param params: FactorMach.params
+    :return: (bias, xV), 1d and 2d np.ndarray, with
+        y(context + item) = bias(context) + bias(item) + 2 * <xV(context), xV(item)>
+        where bias(x) = x.w + sum_f [(xV)_f^2 - (x^2 V^2)_f], the pairwise scale used by FactorMach
+    """
+    V = np.asarray(params['V'], dtype=np.float32)
+    w = np.asarray(params['w'], dtype=np.float32).reshape((-1))
+    if scipy.sparse.issparse(x):
+        x = scipy.sparse.csr_matrix(x, dtype=np.float32)
+        X2 = x.multiply(x)
+    else:
+        x = np.asarray(x, dtype=np.float32)
+        X2 = x * x
+    XV = np.asarray(x.dot(V))
+    X2V2 = np.asarray(X2.dot(V * V))
+    bias = np.asarray(x.dot(w)).reshape((-1)) + (XV * XV - X2V2).sum(axis=1)
+    return np.float32(bias), np.float32(XV)
+
+
+def kmeans(x, num_clusters, num_iters=10, seed=0, chunk_size=65536):
+    """
+    Lloyd's algorithm
+    :param x: 2d np.ndarray, each row stores a point
+    :return: (centroids, assignments)
+    """
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(x.shape[0], num_clusters, replace=False)].copy()
+    assignments = np.zeros((x.shape[0],), dtype=np.int32)
+    for it in range(num_iters):
+        # argmin ||x - c||^2 = argmax 2 <x, c> - ||c||^2, chunked to bound the distance matrix
+        c_norm = (centroids * centroids).sum(axis=1)
+        for a in range(0, x.shape[0], chunk_size):
+            assignments[a: a + chunk_size] = np.argmax(2 * np.dot(x[a: a + chunk_size], centroids.T) - c_norm, axis=1)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty].reshape((-1, 1))
+        # re-seed the empty clusters with random points
+        centroids[~non_empty] = x[rng.choice(x.shape[0], (~non_empty).sum(), replace=False)]
+    return centroids, assignments
+
+
+class FMRetrievalIndex(object):
+    def __init__(self, params, item_x, num_clusters=None, num_iters=10, seed=0):
+        """
+        maximum-inner-product index over the items of a trained FactorMach, returning the top scored items of a context
+        without scoring the whole catalogue. the item side of the score is folded into
+        p = [xV(item), bias(item)] and the context side into q = [2 xV(context), 1], so that ranking items is MIPS of q
+        over p. appending sqrt(M^2 - ||p||^2) to p, M = max ||p||, turns MIPS into nearest neighbour search, which is
+        served by an inverted file over k-means clusters
+        :param params: FactorMach.params
+        :param item_x: 2d np.ndarray or scipy.sparse matrix, (num_items, input_dim), each row sets the features of an
+            item only, the context features left zero
+        :param num_clusters: number of inverted lists, sqrt(num_items) if None, 0 for exact brute force search only
+        :param num_iters: k-means iterations
+        :param seed:
+        """
+        self.params = params
+        self.w0 = np.float32(params['w0'])
+        item_bias, item_V = fm_parts(item_x, params)
+        self.item_p = np.concatenate((item_V, item_bias.reshape((-1, 1))), axis=1)
+        num_items = self.item_p.shape[0]
+        if num_clusters is None:
+            num_clusters = int(np.ceil(np.sqrt(num_items)))
+        self.num_clusters = num_clusters
+        if num_clusters > 0:
+            p_norm2 = (self.item_p * self.item_p).sum(axis=1)
+            augmented = np.concatenate((self.item_p, np.sqrt(p_norm2.max() - p_norm2).reshape((-1, 1))), axis=1)
+            centroids, assignments = kmeans(augmented, num_clusters, num_iters, seed)
+            # the query has a zero in the augmented dimension, so only the first columns of the centroids matter
+            # when ranking the clusters by 2 <q, c> - ||c||^2
+            self.centroids = centroids[:, :-1]
+            self.centroid_norm2 = (centroids * centroids).sum(axis=1)
+            # inverted lists stored as item ids sorted by cluster plus offsets
+            self.list_items = np.argsort(assignments, kind='mergesort').astype(np.int32)
+            self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=num_clusters))))
+
+    def search(self, context_x, k=10, n_probe=None):
+        """
+        :param context_x: 2d np.ndarray or scipy.sparse matrix, (num_contexts, input_dim), context features only
+        :param k: number of items returned per context
+        :param n_probe: number of inverted lists scanned per context, the recall knob: more lists, higher recall and
+            more items scored. None or num_clusters gives the exact top k by brute force
+        :return: (items, scores), 2d np.ndarray (num_contexts, k), item ids in decreasing order of FactorMach score and
+            the scores themselves, as FactorMach.predict would give for the combined row. rows with fewer than k
+            candidates are padded with -1 and -inf
+        """
+        context_bias, context_V = fm_parts(context_x, self.params)
+        q = np.concatenate((2 * context_V, np.ones((context_V.shape[0], 1), np.float32)), axis=1)
+        num_contexts = q.shape[0]
+        items = np.full((num_contexts, k), -1, dtype=np.int32)
+        scores = np.full((num_contexts, k), -np.inf, dtype=np.float32)
+        exact = self.num_clusters == 0 or n_probe is None or n_probe >= self.num_clusters
+        if exact:
+            all_scores = np.dot(q, self.item_p.T)
+        else:
+            cluster_scores = 2 * np.dot(q, self.centroids.T) - self.centroid_norm2
+        for n in range(num_contexts):
+            if exact:
+                candidates = np.arange(self.item_p.shape[0])
+                candidate_scores = all_scores[n]
+            else:
+                probed = np.argpartition(-cluster_scores[n], n_probe - 1)[:n_probe]
+                candidates = np.concatenate([self.list_items[self.list_offsets[c]: self.list_offsets[c + 1]] for c in probed])
+                candidate_scores = np.dot(self.item_p[candidates], q[n])
+            m = min(k, len(candidates))
+            if m == 0:
+                continue
+            top = np.argpartition(-candidate_scores, m - 1)[:m]
+            top = top[np.argsort(-candidate_scores[top])]
+            items[n, :m] = candidates[top]
+            scores[n, :m] = candidate_scores[top] + context_bias[n] + self.w0
+        return items, scores
+
+    def recall(self, context_x, k=10, n_probe=1):
+        """
+        fraction of the exact top k recovered with n_probe lists, to tune n_probe
+        :return: float
+        """
+        exact_items, _ = self.search(context_x, k)
+        approx_items, _ = self.search(context_x, k, n_probe)
+        hits = sum(len(np.intersect1d(a[a >= 0], b[b >= 0])) for a, b in zip(exact_items, approx_items))
+        return 1.0 * hits / (exact_items >= 0).sum()
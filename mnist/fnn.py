@@ -4,6 +4,10 @@ import tensorflow as tf
 import cPickle
 from tensorflow.examples.tutorials.mnist import input_data
 
+from util import Struct, GraphWrapper, auto_chunk_size, iterate_chunks, write_chunks
+from runtime import RUNTIME, new_token
+from model_io import save_params, load_params
+
 def weight_variable(shape):
     initial = tf.truncated_normal(shape, stddev=1.0 / np.sqrt(shape[0]), seed=0)
     return tf.Variable(initial)
@@ -11,55 +15,36 @@ def weight_variable(shape):
 def bias_variable(shape):
     return tf.Variable(np.zeros(shape, dtype=np.float32))
 
-class Struct(dict):
-    def __init__(self, **kwargs):
-        super(Struct, self).__init__(**kwargs)
-        self.__dict__ = self
-
-class GraphWrapper(object):
-    def __init__(self, graph, phr, var, tsr, ops):
-        self.graph = graph
-        self.phr = phr
-        self.var = var
-        self.tsr = tsr
-        self.ops = ops
-
 class FCNN(object):
     def __init__(self):
         # 模型的参数,对应于Graph中的trainable variables
         self.params = {}
-        # Graph and session for online running
-        self.updated = True
-        self.G_run = None
-        self.sess_run = None
+        # identifies the current params to the shared runtime, see runtime.new_token
+        self.token = None
 
-    def __build_graph__(self, input_dim=None, num_classes=None, size_hidden_layer=None, var_val=None):
+    def __runtime__(self, input_dim, num_classes, size_hidden_layer):
+        """
+        :return: runtime.RuntimeEntry of the graph of this architecture, built on the first call only
+        """
+        return RUNTIME.get(('fcnn', input_dim, num_classes, size_hidden_layer),
+                           lambda: self.__build_graph__(input_dim, num_classes, size_hidden_layer))
+
+    def __build_graph__(self, input_dim, num_classes, size_hidden_layer):
         """
         Define the structure of the graph
         :param input_dim:
         :param num_classes:
         :param size_hidden_layer:
-        :param var_val:
         :return:
         """
         graph = tf.Graph()
         with graph.as_default():
-            if var_val is not None:
-                input_dim = var_val['W_h1'].shape[0]
-                num_classes = var_val['W_smx'].shape[1]
-                # 1st hidden layer
-                W_h1 = tf.Variable(var_val['W_h1'])
-                b_h1 = tf.Variable(var_val['b_h1'])
-                # softmax layer
-                W_smx = tf.Variable(var_val['W_smx'])
-                b_smx = tf.Variable(var_val['b_smx'])
-            else:
-                # 1st hidden layer
-                W_h1 = weight_variable([input_dim, size_hidden_layer])
-                b_h1 = bias_variable([size_hidden_layer])
-                # softmax layer
-                W_smx = weight_variable([size_hidden_layer, num_classes])
-                b_smx = bias_variable([num_classes])
+            # 1st hidden layer
+            W_h1 = weight_variable([input_dim, size_hidden_layer])
+            b_h1 = bias_variable([size_hidden_layer])
+            # softmax layer
+            W_smx = weight_variable([size_hidden_layer, num_classes])
+            b_smx = bias_variable([num_classes])
             x = tf.placeholder(tf.float32, [None, input_dim])
             y_ = tf.placeholder(tf.float32, [None, num_classes])
             keep_prob = tf.placeholder(tf.float32, name='keep_prob')
@@ -92,47 +77,62 @@ class FCNN(object):
         y = np.int32(y)
         num_classes = y.max() + 1
         y = self.__ordinal_to_onehot__(y)
-        G = self.__build_graph__(input_dim, num_classes, size_hidden_layer)
-        sess = tf.Session(graph=G.graph)
-        with sess.as_default():
-            G.ops.init_vars.run()
-            head = 0
-            indices = range(num_samples)
-            for i in range(num_epochs):
-                if head + batch_size > num_samples:
-                    indices = np.random.permutation(num_samples)
-                    head = 0
-                selected = indices[head: head + batch_size]
-                head += batch_size
-                batch_x = x[selected]
-                batch_y = y[selected]
-                if verbose:
-                    if i % 100 == 0:
-                        accuracy = G.tsr.accuracy.eval(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y, G.phr.keep_prob: 1.0})
-                        print 'step {s}, accuracy on the training batch is {a:.2f}%'.format(s=i, a=accuracy * 100.0)
-                G.ops.train_step.run(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y,
-                                                G.phr.learning_rate: learning_rate,
-                                                G.phr.keep_prob: keep_prob})
-            for k, v in G.var.iteritems():
-                self.params[k] = G.var[k].eval()
-        self.updated = True
+        entry = self.__runtime__(input_dim, num_classes, size_hidden_layer)
+        G = entry.G
+        with entry.training_session() as sess:
+            with sess.as_default():
+                head = 0
+                indices = range(num_samples)
+                for i in range(num_epochs):
+                    if head + batch_size > num_samples:
+                        indices = np.random.permutation(num_samples)
+                        head = 0
+                    selected = indices[head: head + batch_size]
+                    head += batch_size
+                    batch_x = x[selected]
+                    batch_y = y[selected]
+                    if verbose:
+                        if i % 100 == 0:
+                            accuracy = G.tsr.accuracy.eval(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y, G.phr.keep_prob: 1.0})
+                            print 'step {s}, accuracy on the training batch is {a:.2f}%'.format(s=i, a=accuracy * 100.0)
+                    G.ops.train_step.run(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y,
+                                                    G.phr.learning_rate: learning_rate,
+                                                    G.phr.keep_prob: keep_prob})
+            self.token = new_token()
+            self.params = entry.fetch(sess)
 
-    def predict_proba(self, x):
+    def predict_proba(self, x, out=None, chunk_size=None, memory_budget=64 * 2 ** 20):
         """
-        :param x:
+        :param x: 2d np.ndarray, np.memmap, list of rows or iterator of 2d np.ndarray, scored chunk by chunk
+        :param out: 2d np.ndarray (N, num_classes), possibly a np.memmap, the probas are written into it when given,
+            so that peak memory depends on the chunk size only
+        :param chunk_size: rows per session run, derived from memory_budget if None
+        :param memory_budget: bytes held by one chunk, input, hidden activations and probas
         :return: np.2darray, each row gives the proba of an instance belonging to each class
         """
+        num_classes = self.params['W_smx'].shape[1] if len(self.params) > 0 else 0
+        if out is None and hasattr(x, 'shape'):
+            out = np.empty((x.shape[0], num_classes), dtype=np.float32)
+        return write_chunks(self.iter_predict_proba(x, chunk_size, memory_budget), num_classes, out)
+
+    def iter_predict_proba(self, x, chunk_size=None, memory_budget=64 * 2 ** 20):
+        """
+        streaming counterpart of predict_proba
+        :return: iterator of 2d np.ndarray, the probas of consecutive chunks of x
+        """
         if len(self.params) < 1:
             raise Exception("empty model")
-        if self.updated:
-            print 'updating running Graph...'
-            self.G_run = self.__build_graph__(var_val=self.params)
-            if self.sess_run is not None: self.sess_run.close()
-            self.sess_run = tf.Session(graph=self.G_run.graph)
-            self.sess_run.run(self.G_run.ops.init_vars)
-            self.updated = False
-        proba = self.sess_run.run(self.G_run.tsr.y, feed_dict={self.G_run.phr.x: x, self.G_run.phr.keep_prob: 1.0})
-        return proba
+        input_dim, size_hidden_layer = self.params['W_h1'].shape
+        num_classes = self.params['W_smx'].shape[1]
+        entry = self.__runtime__(input_dim, num_classes, size_hidden_layer)
+        if chunk_size is None:
+            # relu and dropout each hold a hidden activation, logits and softmax each a row of probas
+            chunk_size = auto_chunk_size(4 * (input_dim + 2 * size_hidden_layer + 2 * num_classes), memory_budget)
+        for chunk in iterate_chunks(x, chunk_size):
+            # a session is held per chunk only, not while the caller consumes the probas
+            with entry.session(self.params, self.token) as sess:
+                proba = sess.run(entry.G.tsr.y, feed_dict={entry.G.phr.x: chunk, entry.G.phr.keep_prob: 1.0})
+            yield proba
 
     def predict(self, x):
         """
@@ -143,25 +143,26 @@ class FCNN(object):
         return np.argmax(proba, 1)
 
     def save(self, path):
+        """
+        :param path: directory, see model_io.save_params
+        """
         if len(self.params) < 1:
             raise Exception("empty model")
-        with open(path, "wb") as f:
-            cPickle.dump(self.params, f)
+        save_params(path, self.params)
 
-    def load(self, path):
-        with open(path, "rb") as f:
-            self.params = cPickle.load(f)
-        self.updated = True
+    def load(self, path, mmap=True):
+        """
+        :param path: directory written by save, or a file written by the former cPickle format
+        :param mmap: if True the params are memory-mapped, see model_io.load_params
+        """
+        self.params = load_params(path, mmap)
+        self.token = new_token()
 
     def __ordinal_to_onehot__(self, y):
         yy = np.zeros((y.shape[0], y.max()+1), dtype=np.int32)
         yy[np.arange(y.shape[0]), y] = 1
         return yy
 
-    def __del__(self):
-        if self.sess_run is not None:
-            self.sess_run.close()
-
 if __name__ == '__main__':
     mnist = input_data.read_data_sets("MNIST_data/", one_hot=False)
     fcnn = FCNN()
@@ -180,14 +181,15 @@ if __name__ == '__main__':
     print 'test accuracy is {a:.2f}%'.format(a=accuracy * 100.0)
     fcnn.save("model")
     
-    # test serialisation
+    # test serialisation, the memory-mapped format and the former cPickle one
     with open("model_param", "wb") as f:
         cPickle.dump(fcnn.params, f)
     
-    with open("model_param", "rb") as f:
-        params = cPickle.load(f)
     fcnn2 = FCNN()
-    fcnn2.params = params
+    fcnn2.load("model")
+    accuracy = np.mean(fcnn2.predict(mnist.test.images) == mnist.test.labels)
+    print 'test accuracy is {a:.2f}%'.format(a=accuracy * 100.0)
+    fcnn2.load("model_param")
     accuracy = np.mean(fcnn2.predict(mnist.test.images) == mnist.test.labels)
     print 'test accuracy is {a:.2f}%'.format(a=accuracy * 100.0)
     accuracy = np.mean(fcnn2.predict(mnist.test.images) == mnist.test.labels)
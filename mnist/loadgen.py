@@ -0,0 +1,78 @@
+# coding=utf-8
+import json
+import time
+import httplib
+import threading
+import numpy as np
+
+
+def run_client(host, port, model, rows, num_requests, latencies, errors):
+    """
+    send num_requests single-row requests one after another over one keep-alive connection
+    :param rows: 2d np.ndarray, cycled through
+    :param latencies: list the latencies in seconds are appended to
+    :param errors: list the failures are appended to
+    """
+    conn = httplib.HTTPConnection(host, port)
+    headers = {'Content-Type': 'application/json'}
+    for i in range(num_requests):
+        body = json.dumps({'x': rows[i % rows.shape[0]].tolist()})
+        t0 = time.time()
+        try:
+            conn.request('POST', '/predict/{m}'.format(m=model), body, headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except Exception as e:
+            errors.append(str(e))
+            conn.close()
+            conn = httplib.HTTPConnection(host, port)
+            continue
+        latencies.append(time.time() - t0)
+    conn.close()
+
+
+def load_test(model, rows=None, host='127.0.0.1', port=8000, num_clients=32, num_requests=200, seed=0):
+    """
+    hammer a model of serve.py with concurrent single-row requests over the loopback
+    :param model: name of the served model
+    :param rows: 2d np.ndarray of inputs, random binary rows of the input_dim of the model if None
+    :param num_clients: concurrent connections, one thread each
+    :param num_requests: requests per client
+    :return: dict of requests/sec and latency percentiles in ms
+    """
+    if rows is None:
+        conn = httplib.HTTPConnection(host, port)
+        conn.request('GET', '/models')
+        input_dim = json.loads(conn.getresponse().read())[model]['input_dim']
+        conn.close()
+        rows = np.float32(np.random.RandomState(seed).random_sample((1000, input_dim)) < 0.2)
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=run_client, args=(host, port, model, rows[k::num_clients] if rows.shape[0] >= num_clients else rows,
+                                                         num_requests, latencies, errors))
+               for k in range(num_clients)]
+    t0 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - t0
+    latencies = np.array(latencies) * 1000.0
+    report = {'requests_per_sec': len(latencies) / elapsed, 'errors': len(errors)}
+    for p in (50, 90, 99, 99.9):
+        report['p{p}_ms'.format(p=p)] = np.percentile(latencies, p) if len(latencies) > 0 else None
+    report['max_ms'] = latencies.max() if len(latencies) > 0 else None
+    print '{c} clients x {n} requests, {e} errors'.format(c=num_clients, n=num_requests, e=len(errors))
+    if len(latencies) > 0:
+        print '{r:.1f} requests/sec, latency p50 {p50:.2f} ms, p90 {p90:.2f} ms, p99 {p99:.2f} ms, p99.9 {p999:.2f} ms, max {m:.2f} ms'.format(
+            r=report['requests_per_sec'], p50=report['p50_ms'], p90=report['p90_ms'], p99=report['p99_ms'],
+            p999=report['p99.9_ms'], m=report['max_ms'])
+    return report
+
+
+if __name__ == '__main__':
+    for num_clients in (1, 8, 32, 128):
+        load_test('softmax', num_clients=num_clients)
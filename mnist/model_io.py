@@ -0,0 +1,109 @@
+# coding=utf-8
+import os
+import json
+import shutil
+import tempfile
+import cPickle
+import numpy as np
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+
+def save_params(path, params, meta=None):
+    """
+    save a model as a directory of raw .npy arrays plus a JSON manifest, so that load_params can memory-map every
+    array instead of unpickling a copy of it. every save writes a new version directory next to path, and path is a
+    symlink renamed onto it once it is complete, so that a reader sees the former model or the new one, never a half
+    written or a missing one. the version the symlink pointed to is kept for readers still loading it, older ones are
+    removed
+    :param path: symlink to the current version. a directory (the layout of former saves) or a file (e.g. a former
+        cPickle dump) at that path is replaced, that once without the atomic swap
+    :param params: dict, name -> np.ndarray (or scalar), or list of np.ndarray, e.g. the W_list of DBN
+    :param meta: dict of JSON-serialisable values stored along, e.g. the validation loss
+    """
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    prefix = '.{n}.v'.format(n=os.path.basename(path))
+    version = tempfile.mkdtemp(dir=parent, prefix=prefix)
+    try:
+        arrays = {}
+        for name, value in params.iteritems():
+            if isinstance(value, (list, tuple)):
+                files = ['{n}.{i}.npy'.format(n=name, i=i) for i in range(len(value))]
+                values = value
+            else:
+                files = ['{n}.npy'.format(n=name)]
+                values = [value]
+            values = [np.asarray(v) for v in values]
+            for f, v in zip(files, values):
+                np.save(os.path.join(version, f), v)
+            arrays[name] = {'files': files, 'list': isinstance(value, (list, tuple)),
+                            'shapes': [list(v.shape) for v in values], 'dtypes': [v.dtype.str for v in values]}
+        # written last, it marks the version complete
+        with open(os.path.join(version, MANIFEST), 'w') as f:
+            json.dump({'version': FORMAT_VERSION, 'arrays': arrays, 'meta': meta or {}}, f, indent=2, sort_keys=True)
+    except Exception:
+        shutil.rmtree(version, ignore_errors=True)
+        raise
+    previous = None
+    if os.path.islink(path):
+        previous = os.path.join(parent, os.readlink(path))
+    elif os.path.isdir(path):
+        previous = tempfile.mkdtemp(dir=parent, prefix=prefix)
+        os.rename(path, previous)
+    elif os.path.exists(path):
+        os.remove(path)
+    link = tempfile.mktemp(dir=parent, prefix='.{n}.link'.format(n=os.path.basename(path)))
+    os.symlink(os.path.basename(version), link)
+    # atomic on posix, the symlink is replaced in one step
+    os.rename(link, path)
+    keep = set(os.path.abspath(p) for p in (version, previous) if p is not None)
+    for entry in os.listdir(parent):
+        p = os.path.join(parent, entry)
+        # the versions of this model only, not those of a model named e.g. <name>.v2, nor one being written
+        if (entry.startswith(prefix) and '.' not in entry[len(prefix):] and os.path.abspath(p) not in keep
+                and os.path.exists(os.path.join(p, MANIFEST))):
+            shutil.rmtree(p, ignore_errors=True)
+
+
+def load_manifest(path):
+    """
+    :return: dict, the manifest of a model saved by save_params
+    """
+    with open(os.path.join(path, MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version', 0) > FORMAT_VERSION:
+        raise Exception("{p} has model format version {v}, newer than {c}".format(p=path, v=manifest['version'], c=FORMAT_VERSION))
+    return manifest
+
+
+def load_params(path, mmap=True):
+    """
+    :param path: directory written by save_params, or a file written by the former cPickle.dump of save
+    :param mmap: if True the arrays are memory-mapped read-only: nothing is read before it is touched, and processes
+        loading the same model share the physical pages
+    :return: params as given to save_params, or the unpickled object of a cPickle file
+    """
+    if not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            return cPickle.load(f)
+    # the version the symlink points to now, read whole even if a save swaps it meanwhile
+    path = os.path.realpath(path)
+    manifest = load_manifest(path)
+    params = {}
+    for name, entry in manifest['arrays'].iteritems():
+        values = []
+        for f, shape in zip(entry['files'], entry['shapes']):
+            # scalars such as the w0 of FactorMach are read outright
+            mmap_mode = 'r' if mmap and len(shape) > 0 else None
+            values.append(np.load(os.path.join(path, f), mmap_mode=mmap_mode))
+        params[str(name)] = values if entry['list'] else values[0]
+    return params
+
+
+def load_meta(path):
+    """
+    :return: dict, the meta given to save_params
+    """
+    return load_manifest(path)['meta']
@@ -3,16 +3,33 @@ import tensorflow as tf
 import numpy as np
 import cPickle
 import copy
+import threading
 import Image
 import matplotlib.pyplot as plt
 from tensorflow.examples.tutorials.mnist import input_data
 
 from vis_util import tile_raster_images
-from util import Struct, GraphWrapper, iterate_dataset, sigmoid, sample_binomial
+from util import Struct, GraphWrapper, iterate_dataset, sigmoid, sample_binomial, PackedBinaryDataset, BackgroundWorker
+from sampling_util import GibbsBuffers, hidden_preactivation
 
 
 class RBM(object):
-    def __init__(self, n_visible, n_hidden, gibbs_steps=1, batch_size=50, num_epochs=10000, learning_rate=1e-3, probe_epochs=50):
+    def __init__(self, n_visible, n_hidden, gibbs_steps=1, batch_size=50, num_epochs=10000, learning_rate=1e-3, probe_epochs=50, sample_in_graph=False, persistent=False, sparse_threshold=None, probe_mode='full', probe_size=None):
+        """
+        :param sample_in_graph: if True, the k-step CD chain is built into the graph, so that one session.run samples
+            and updates without copying W, b, c out of the session and feeding v_sampling back in
+        :param persistent: if True, train by persistent contrastive divergence: batch_size fantasy particles, kept in a
+            preallocated array (or a variable when sample_in_graph) and initialised from the first batch, are advanced
+            by gibbs_steps Gibbs steps per update instead of restarting the chain from the data, so that gibbs_steps=1
+            is usually enough
+        :param sparse_threshold: if set, the hidden pre-activations of inputs whose fraction of non-zeros is below it
+            are computed by summing the rows of W of the active visible units instead of a dense matmul, both in the
+            numpy chains and in the graph. see bench_rbm.bench_sparse_hidden for the crossover density
+        :param probe_mode: how the validation reconstruction MAE is computed at each probe, see ReconstructionProbe.
+            'full' reconstructs the whole validation set in the training loop, 'subset' a rotating window of probe_size
+            rows merged into a running estimate, 'async' hands a snapshot of the weights to a background thread
+        :param probe_size: rows per probe for 'subset', and for 'async' if set
+        """
         self.params = {}
         self.n_visible = n_visible
         self.n_hidden = n_hidden
@@ -21,43 +38,108 @@ class RBM(object):
         self.num_epochs = num_epochs
         self.learning_rate = learning_rate
         self.probe_epochs = probe_epochs
+        self.sample_in_graph = sample_in_graph
+        self.persistent = persistent
+        self.sparse_threshold = sparse_threshold
+        self.probe_mode = probe_mode
+        self.probe_size = probe_size
+        # fantasy particles of persistent contrastive divergence, (batch_size, n_visible)
+        self.fantasy_v = None
 
-    def fit(self, v, validation_v=None):
+    def fit(self, v, validation_v=None, monitor=None):
         """
-        :param v: 2d np.ndarray, each row stores a sample
+        :param v: 2d np.ndarray or util.PackedBinaryDataset, each row stores a sample
         :param validation_v:
+        :param monitor: ais.AISMonitor, if given a snapshot of the parameters is handed to it at every probe, the latest
+            log-likelihood estimate is printed, and training stops early once monitor.should_stop(). it is closed when
+            training ends, its history stays readable
         :return:
         """
-        if ((v == 0.0) | (v == 1.0)).sum() != v.shape[0] * v.shape[1]:
+        # a packed dataset is binary by construction
+        if not isinstance(v, PackedBinaryDataset) and ((v == 0.0) | (v == 1.0)).sum() != v.shape[0] * v.shape[1]:
             raise Exception('v should be binary')
         msg = '{t} training samples'.format(t=v.shape[0])
         if validation_v is not None:
             msg += ', {v} validation samples'.format(v=validation_v.shape[0])
         msg += ', R^{d}'.format(d=v.shape[1])
         print msg
+        self.fit_batches(iterate_dataset(v, None, self.batch_size), validation_v, monitor)
+
+    def fit_batches(self, batches, validation_v=None, monitor=None, snapshot_epochs=None, on_snapshot=None):
+        """
+        train on the batches drawn from an iterator, see fit
+        :param batches: iterator of 2d np.ndarray, (batch_size, n_visible), binary
+        :param validation_v:
+        :param monitor: see fit
+        :param snapshot_epochs: on_snapshot(step, params) is called every snapshot_epochs steps with a copy of W, b, c
+        :param on_snapshot:
+        :return:
+        """
         G = self.__build_graph__()
         sess = tf.Session(graph=G.graph)
         with sess.as_default():
             np.random.seed(3)
             G.ops.init_vars.run()
-            dataset = iterate_dataset(v, None, self.batch_size)
-            for i in range(self.num_epochs):
-                batch_v = dataset.next()
-                batch_v_sampling = self.gibbs_v(v0=batch_v, W=G.var.W.eval(), b=G.var.b.eval(), c=G.var.c.eval(), k=self.gibbs_steps)
-                if i % self.probe_epochs == 0:
-                    loss = G.tsr.loss.eval(feed_dict={G.phr.v: batch_v, G.phr.v_sampling: batch_v_sampling})
-                    msg = 'step {i}, loss {l:.4f}'.format(i=i, l=loss)
-                    if validation_v is not None:
-                        # reconstruct the visible units by single step Gibbs sampling
-                        reconstruct_v = self.gibbs_v(v0=validation_v, W=G.var.W.eval(), b=G.var.b.eval(), c=G.var.c.eval(), k=1)
-                        mae = 1.0 * np.abs(reconstruct_v - validation_v).sum() / validation_v.shape[0]
-                        msg += ", validation reconstruct MAE {e:.4f}".format(e=mae)
-                    print msg
-                G.ops.train_step.run(feed_dict={G.phr.v: batch_v, G.phr.v_sampling: batch_v_sampling, G.phr.learning_rate: self.learning_rate})
+            buffers = GibbsBuffers(self.n_visible, self.n_hidden, self.batch_size, seed=np.random.randint(2 ** 31))
+            probe = None
+            if validation_v is not None:
+                probe = ReconstructionProbe(validation_v, self.probe_mode, self.probe_size, self.sparse_threshold, seed=np.random.randint(2 ** 31))
+            try:
+                self.__train__(G, batches, buffers, probe, monitor, snapshot_epochs, on_snapshot)
+            finally:
+                # the background threads of the async probe and of the monitor end with the training
+                if probe is not None:
+                    probe.close()
+                if monitor is not None:
+                    monitor.close()
             for k, v in G.var.iteritems():
                 self.params[k] = G.var[k].eval()
+            if self.persistent and self.sample_in_graph:
+                self.fantasy_v = G.tsr.fantasy_v.eval()
         self.updated = True
 
+    def __train__(self, G, batches, buffers, probe, monitor, snapshot_epochs, on_snapshot):
+        """
+        the training loop of fit_batches, run in the default session of G
+        """
+        for i in range(self.num_epochs):
+            batch_v = batches.next()
+            if self.sample_in_graph:
+                if self.persistent and i == 0:
+                    G.ops.init_fantasy.run(feed_dict={G.phr.v: batch_v})
+                feed_dict = {G.phr.v: batch_v}
+            else:
+                if self.persistent:
+                    if i == 0:
+                        self.fantasy_v = np.array(batch_v, dtype=np.float32)
+                    self.fantasy_v[...] = self.gibbs_v(v0=self.fantasy_v, W=G.var.W.eval(), b=G.var.b.eval(), c=G.var.c.eval(), k=self.gibbs_steps, buffers=buffers, sparse_threshold=self.sparse_threshold)
+                    batch_v_sampling = self.fantasy_v
+                else:
+                    batch_v_sampling = self.gibbs_v(v0=batch_v, W=G.var.W.eval(), b=G.var.b.eval(), c=G.var.c.eval(), k=self.gibbs_steps, buffers=buffers, sparse_threshold=self.sparse_threshold)
+                feed_dict = {G.phr.v: batch_v, G.phr.v_sampling: batch_v_sampling}
+            if i % self.probe_epochs == 0:
+                loss = G.tsr.loss.eval(feed_dict=feed_dict)
+                msg = 'step {i}, loss {l:.4f}'.format(i=i, l=loss)
+                if probe is not None:
+                    result = probe.probe(i, G.var.W.eval(), G.var.b.eval(), G.var.c.eval())
+                    if result is not None:
+                        msg += ", validation reconstruct MAE {e:.4f}".format(e=result[1])
+                        if result[0] != i:
+                            msg += " at step {s}".format(s=result[0])
+                if monitor is not None:
+                    monitor.submit(i, G.var.W.eval(), G.var.b.eval(), G.var.c.eval())
+                    latest = monitor.latest()
+                    if latest is not None:
+                        msg += ", log-likelihood {l:.4f} at step {s}".format(l=latest[1], s=latest[0])
+                print msg
+                if monitor is not None and monitor.should_stop():
+                    print 'step {i}, early stopping, no log-likelihood improvement in {p} estimates'.format(i=i, p=monitor.patience)
+                    break
+            if on_snapshot is not None and i > 0 and i % snapshot_epochs == 0:
+                on_snapshot(i, dict([(k, var.eval()) for k, var in G.var.iteritems()]))
+            feed_dict[G.phr.learning_rate] = self.learning_rate
+            G.ops.train_step.run(feed_dict=feed_dict)
+
     def __build_graph__(self):
         graph = tf.Graph()
         with graph.as_default():
@@ -70,15 +152,34 @@ class RBM(object):
             b = tf.Variable(np.zeros((self.n_visible,), np.float32), trainable=True)
             c = tf.Variable(np.zeros((self.n_hidden,), np.float32), trainable=True)
             v = tf.placeholder(tf.float32, [None, self.n_visible])
-            v_sampling = tf.placeholder(tf.float32, [None, self.n_visible])
+            if self.sample_in_graph:
+                if self.persistent:
+                    fantasy_v = tf.Variable(np.zeros((self.batch_size, self.n_visible), np.float32), trainable=False)
+                    init_fantasy = tf.assign(fantasy_v, v)
+                    v0 = fantasy_v
+                else:
+                    v0 = v
+                # the chain is a sample, not a function of the parameters to differentiate through
+                v_sampling = tf.stop_gradient(self.__gibbs_v_graph__(v0, W, b, c, self.gibbs_steps))
+            else:
+                v_sampling = tf.placeholder(tf.float32, [None, self.n_visible])
             learning_rate = tf.placeholder(tf.float32)
             loss = tf.reduce_mean(self.__calc_free_energy__(v, W, b, c)) - tf.reduce_mean(self.__calc_free_energy__(v_sampling, W, b, c))
             train_step = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+            if self.sample_in_graph and self.persistent:
+                # the particles are read by the chain before being overwritten, assign depends on v_sampling
+                train_step = tf.group(train_step, tf.assign(fantasy_v, v_sampling))
             init_vars = tf.initialize_all_variables()
-        phr = Struct(v=v, v_sampling=v_sampling, learning_rate=learning_rate)
+        if self.sample_in_graph:
+            phr = Struct(v=v, learning_rate=learning_rate)
+        else:
+            phr = Struct(v=v, v_sampling=v_sampling, learning_rate=learning_rate)
         var = Struct(W=W, b=b, c=c)
         tsr = Struct(loss=loss)
         ops = Struct(train_step=train_step, init_vars=init_vars)
+        if self.sample_in_graph and self.persistent:
+            tsr.fantasy_v = fantasy_v
+            ops.init_fantasy = init_fantasy
         return GraphWrapper(graph, phr, var, tsr, ops)
 
     def __calc_free_energy__(self, V, W, b, c):
@@ -89,45 +190,209 @@ class RBM(object):
         :param c: 1d tensor, (n_hidden, )
         :return: the free energy of each sample, 1d tensor, (N,)
         """
-        return -tf.reshape(tf.matmul(V, tf.reshape(b, [-1, 1])), [-1]) - tf.reduce_sum(tf.log(1 + tf.exp(c + tf.matmul(V, W))), reduction_indices=1)
+        return -tf.reshape(tf.matmul(V, tf.reshape(b, [-1, 1])), [-1]) - tf.reduce_sum(tf.log(1 + tf.exp(self.__hidden_preactivation_graph__(V, W, c))), reduction_indices=1)
+
+    def __hidden_preactivation_graph__(self, v, W, c):
+        """
+        graph counterpart of sampling_util.hidden_preactivation, the path is chosen at run time from the density of v
+        :param v: 2d tensor, (N, n_visible)
+        :return: 2d tensor, (N, n_hidden), c + v W
+        """
+        def dense():
+            return c + tf.matmul(v, W)
+
+        def sparse():
+            active = tf.where(tf.not_equal(v, 0.0))
+            values = tf.gather_nd(v, active)
+            gathered = tf.gather(W, active[:, 1]) * tf.reshape(values, [-1, 1])
+            return c + tf.unsorted_segment_sum(gathered, active[:, 0], tf.shape(v)[0])
+
+        if self.sparse_threshold is None:
+            return dense()
+        density = tf.reduce_mean(tf.cast(tf.not_equal(v, 0.0), tf.float32))
+        return tf.cond(density < self.sparse_threshold, sparse, dense)
+
+    def __gibbs_v_graph__(self, v0, W, b, c, k):
+        """
+        graph counterpart of gibbs_v, the k steps are unrolled
+        :param v0: 2d tensor, (N, n_visible)
+        :return: 2d tensor, (N, n_visible)
+        """
+        v = v0
+        for i in range(k):
+            h = self.__sample_binomial_graph__(tf.sigmoid(self.__hidden_preactivation_graph__(v, W, c)))
+            v = self.__sample_binomial_graph__(tf.sigmoid(tf.matmul(h, W, transpose_b=True) + b))
+        return v
+
+    def __sample_binomial_graph__(self, proba):
+        """
+        :param proba: success probability, tensor
+        :return: tensor of {0, 1}, float32
+        """
+        return tf.cast(tf.less(tf.random_uniform(tf.shape(proba), minval=0.0, maxval=1.0, dtype=tf.float32), proba), tf.float32)
 
     @staticmethod
-    def gibbs_v(v0, W, b, c, k=1):
+    def gibbs_v(v0, W, b, c, k=1, buffers=None, sparse_threshold=None):
         """
         :param v0: 2d np.ndarray, (N, n_visible)
         :param W: 2d np.nadarray, (n_visible, n_hidden)
         :param b: 1d np.ndarray, (n_visible, )
         :param c: 1d np.ndarray, (n_hidden, )
         :param k:
+        :param buffers: sampling_util.GibbsBuffers, if given the steps run in its float32 buffers without allocating,
+            and the result is a view of them, overwritten by the next call
+        :param sparse_threshold: see sampling_util.hidden_preactivation
         :return:
         """
         v = v0
         for i in range(k):
-            h = RBM.sample_h_given_v(v, W, c)
-            v = RBM.sample_v_given_h(h, W, b)
+            h = RBM.sample_h_given_v(v, W, c, buffers=buffers, sparse_threshold=sparse_threshold)
+            v = RBM.sample_v_given_h(h, W, b, buffers=buffers)
         return v
 
     @staticmethod
-    def sample_h_given_v(v, W, c):
+    def sample_h_given_v(v, W, c, rng=None, buffers=None, sparse_threshold=None):
         """
         :param v: 2d np.ndarray, (N, n_visible)
         :param W: 2d np.nadarray, (n_visible, n_hidden)
         :param c: 1d np.ndarray, (n_hidden, )
+        :param rng: np.random.RandomState, see sample_binomial
+        :param buffers: sampling_util.GibbsBuffers, see gibbs_v, rng is then ignored in favour of buffers.rng
+        :param sparse_threshold: see sampling_util.hidden_preactivation
         :return:
         """
-        proba = sigmoid(np.matmul(v, W) + c)
-        return sample_binomial(proba)
+        if buffers is not None:
+            return buffers.sample_h_given_v(np.asarray(v, np.float32), W, c, sparse_threshold)
+        proba = sigmoid(hidden_preactivation(v, W, c, sparse_threshold))
+        return sample_binomial(proba, rng)
 
     @staticmethod
-    def sample_v_given_h(h, W, b):
+    def sample_v_given_h(h, W, b, rng=None, buffers=None):
         """
         :param v: 2d np.ndarray, (N, n_visible)
         :param W: 2d np.nadarray, (n_visible, n_hidden)
         :param b: 1d np.ndarray, (n_visible, )
+        :param rng: np.random.RandomState, see sample_binomial
+        :param buffers: sampling_util.GibbsBuffers, see gibbs_v, rng is then ignored in favour of buffers.rng
         :return:
         """
+        if buffers is not None:
+            return buffers.sample_v_given_h(np.asarray(h, np.float32), W, b)
         proba = sigmoid(np.matmul(h, W.transpose()) + b)
-        return sample_binomial(proba)
+        return sample_binomial(proba, rng)
+
+    def sample(self, n_samples, burn_in=1000, thinning=100, init=None, n_chains=None, num_threads=1, seed=None, out=None):
+        """
+        draw samples from the learnt distribution with many independent Gibbs chains advanced together, one batched
+        matmul per half step. every chain runs burn_in steps, then gives a sample every thinning steps
+        :param n_samples:
+        :param burn_in:
+        :param thinning:
+        :param init: 2d np.ndarray, (n_chains, n_visible), starting points of the chains, random binary if None
+        :param n_chains: min(n_samples, 1000) if None, overridden by init
+        :param num_threads: the chains are split across that many threads, np.matmul releases the GIL
+        :param seed:
+        :param out: 2d np.ndarray, (n_samples, n_visible), preallocated output, allocated if None
+        :return: out, row d * n_chains + j holds the d-th sample of chain j
+        """
+        if len(self.params) < 1:
+            raise Exception("empty model")
+        W, b, c = self.params['W'], self.params['b'], self.params['c']
+        rng = np.random.RandomState(seed)
+        if init is not None:
+            n_chains = init.shape[0]
+            v0 = np.float32(init)
+        else:
+            if n_chains is None:
+                n_chains = min(n_samples, 1000)
+            v0 = np.float32(rng.uniform(size=(n_chains, self.n_visible)) < 0.5)
+        if out is None:
+            out = np.zeros((n_samples, self.n_visible), np.float32)
+        n_draws = int(np.ceil(1.0 * n_samples / n_chains))
+
+        def run_chains(first, last, chain_rng):
+            v = v0[first: last]
+            for d in range(n_draws):
+                for i in range(burn_in if d == 0 else thinning):
+                    h = RBM.sample_h_given_v(v, W, c, chain_rng)
+                    v = RBM.sample_v_given_h(h, W, b, chain_rng)
+                head = d * n_chains
+                rows = min(head + last, n_samples) - (head + first)
+                if rows > 0:
+                    out[head + first: head + first + rows] = v[:rows]
+
+        bounds = np.linspace(0, n_chains, min(num_threads, n_chains) + 1).astype(np.int32)
+        threads = [threading.Thread(target=run_chains, args=(bounds[t], bounds[t + 1], np.random.RandomState(rng.randint(2 ** 31))))
+                   for t in range(len(bounds) - 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return out
+
+
+class ReconstructionProbe(object):
+    def __init__(self, validation_v, mode='full', probe_size=None, sparse_threshold=None, seed=None):
+        """
+        validation reconstruction MAE of RBM.fit, the mean over the rows of |v - gibbs_v(v, k=1)|.sum()
+        :param validation_v: 2d np.ndarray
+        :param mode: 'full' reconstructs all rows on each probe, synchronously.
+            'subset' reconstructs the next probe_size rows of a rotating window and keeps the latest error of every row,
+            so that the estimate, the mean over the rows probed so far, covers the whole set every
+            len(validation_v) / probe_size probes for a fraction of the cost.
+            'async' does the work of 'full', or of 'subset' if probe_size is set, on a snapshot of the weights in a
+            background thread, the training loop only copies the weights out
+        :param probe_size:
+        :param sparse_threshold: see RBM
+        :param seed:
+        """
+        if mode not in ('full', 'subset', 'async'):
+            raise Exception("unknown probe mode {m}".format(m=mode))
+        if mode == 'subset' and probe_size is None:
+            raise Exception("probe_size must be given for the subset probe")
+        self.validation_v = validation_v
+        self.mode = mode
+        self.probe_size = probe_size
+        self.sparse_threshold = sparse_threshold
+        self.seed = seed
+        # allocated on the first probe, used by one thread at a time
+        self.buffers = None
+        self.head = 0
+        self.errors = np.full((validation_v.shape[0],), np.nan)
+        self.worker = BackgroundWorker() if mode == 'async' else None
+
+    def probe(self, step, W, b, c):
+        """
+        :param step: training step the weights are taken at
+        :param W, b, c: snapshot of the weights, not modified afterwards by the caller
+        :return: (step, MAE) of the latest estimate, None if no estimate is available yet
+        """
+        if self.mode == 'async':
+            self.worker.submit(step, self.__reconstruct__, W, b, c)
+            return self.worker.latest()
+        return step, self.__reconstruct__(W, b, c)
+
+    def close(self):
+        """
+        stop the background thread of the async mode
+        """
+        if self.worker is not None:
+            self.worker.close()
+
+    def __reconstruct__(self, W, b, c):
+        n = self.validation_v.shape[0]
+        if self.probe_size is None or self.probe_size >= n:
+            rows = np.arange(n)
+        else:
+            rows = np.arange(self.head, self.head + self.probe_size) % n
+            self.head = (self.head + self.probe_size) % n
+        v = self.validation_v[rows]
+        if self.buffers is None:
+            self.buffers = GibbsBuffers(W.shape[0], W.shape[1], len(rows), self.seed)
+        # reconstruct the visible units by single step Gibbs sampling
+        reconstruct_v = RBM.gibbs_v(v, W, b, c, k=1, buffers=self.buffers, sparse_threshold=self.sparse_threshold)
+        self.errors[rows] = np.abs(reconstruct_v - v).sum(axis=1)
+        return np.nanmean(self.errors)
 
 
 def test_rbm():
@@ -142,7 +407,7 @@ def test_rbm():
     num_epochs = 500
     probe_epochs = 50
     rbm = RBM(n_visible=28*28, n_hidden=n_hidden, gibbs_steps=gibbs_steps, batch_size=batch_size, num_epochs=num_epochs, learning_rate=learning_rate, probe_epochs=probe_epochs)
-    train_v = np.float32(mnist.train.images > 0)
+    train_v = PackedBinaryDataset.from_dense(mnist.train.images > 0)
     validation_v = np.float32(mnist.validation.images[np.random.permutation(mnist.validation.images.shape[0])][0:1000] > 0)
     rbm.fit(train_v, validation_v)
     
@@ -165,17 +430,10 @@ def test_rbm():
     ax.set_title('gibbs steps {s}'.format(s=gibbs_steps))
     fig.show()
     
-    # sampling from the learnt distribution, starting from randoms
-    probe_steps = 100
-    v_sampling = np.zeros((100, 28*28), np.float32)
+    # sampling from the learnt distribution, starting from randoms, 100 chains run together
     np.random.seed(1)
-    v0 = np.float32(np.random.random((1, 28*28)) > 0.5)
-    v = v0
-    for i in range(probe_steps * 100):
-        if i % probe_steps == 0:
-            v_sampling[int(i/probe_steps), :] = v
-        h = rbm.sample_h_given_v(v, rbm.params['W'], rbm.params['c'])
-        v = rbm.sample_v_given_h(h, rbm.params['W'], rbm.params['b'])
+    v0 = np.float32(np.random.random((100, 28*28)) > 0.5)
+    v_sampling = rbm.sample(100, burn_in=1000, thinning=1, init=v0, seed=1)
     image_sampling = tile_raster_images(v_sampling, (28, 28), (10, 10))
     image_sampling = np.stack((image_sampling, image_sampling, image_sampling), axis=2)
     fig = plt.figure(1)
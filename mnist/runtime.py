@@ -0,0 +1,149 @@
+# coding=utf-8
+import Queue
+import itertools
+import threading
+import contextlib
+import tensorflow as tf
+
+from util import Struct
+
+token_counter = itertools.count(1)
+
+
+def new_token():
+    """
+    :return: int, unique in the process. a model takes a new token whenever its params change, so that a runtime
+        entry knows whether the variables of its session still hold the params of that model
+    """
+    return next(token_counter)
+
+
+class RuntimeEntry(object):
+    def __init__(self, G, num_sessions=1, config=None):
+        """
+        a built graph, a pool of live sessions over it and one assign op per variable. every session holds its own
+        copy of the variables and the token of the params in them, a caller checks a session out for the time of its
+        runs, so that concurrent callers neither race on the assign ops nor wait on a single session
+        :param G: GraphWrapper, whose var holds the variables params are pushed into
+        :param num_sessions: size of the pool
+        :param config: tf.ConfigProto of the sessions, None for the defaults
+        """
+        self.G = G
+        self.config = config
+        with G.graph.as_default():
+            phr = {}
+            ops = []
+            for k, var in G.var.iteritems():
+                phr[k] = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+                ops.append(tf.assign(var, phr[k]))
+            self.assign = Struct(phr=Struct(**phr), op=tf.group(*ops))
+        # token of the params held by the variables of each session, None for the initial values
+        self.tokens = {}
+        self.pool = Queue.Queue()
+        for i in range(num_sessions):
+            sess = tf.Session(graph=G.graph, config=config)
+            sess.run(G.ops.init_vars)
+            self.tokens[sess] = None
+            self.pool.put(sess)
+
+    @contextlib.contextmanager
+    def session(self, params=None, token=None):
+        """
+        check a session out of the pool, waiting for one to be returned if all are in use
+        :param params: dict, variable name -> np.ndarray, pushed into the session unless it already holds them
+        :param token: see new_token
+        :return: context manager giving the tf.Session
+        """
+        sess = self.pool.get()
+        try:
+            if params is not None:
+                self.push(sess, params, token)
+            yield sess
+        finally:
+            self.pool.put(sess)
+
+    def push(self, sess, params, token):
+        """
+        load params into the variables of a checked out session, unless they already hold the params of this token
+        """
+        if token is not None and token == self.tokens[sess]:
+            return
+        feed_dict = dict([(self.assign.phr[k], params[k]) for k in self.assign.phr])
+        sess.run(self.assign.op, feed_dict=feed_dict)
+        self.tokens[sess] = token
+
+    @contextlib.contextmanager
+    def training_session(self):
+        """
+        a session of its own over the graph, its variables freshly initialised, closed on exit. a fit trains in it
+        rather than in one of the pool: the random ops of a new session start over from their op-level seeds, so that
+        a fit starts from the same weights and dropout masks as in a fresh process, and callers of the pool are not
+        held up for the time of the training
+        :return: context manager giving the tf.Session
+        """
+        sess = tf.Session(graph=self.G.graph, config=self.config)
+        try:
+            sess.run(self.G.ops.init_vars)
+            yield sess
+        finally:
+            sess.close()
+
+    def fetch(self, sess):
+        """
+        :return: dict, variable name -> np.ndarray, the values of the variables in sess
+        """
+        return dict([(k, sess.run(var)) for k, var in self.G.var.iteritems()])
+
+    def close(self):
+        for sess in self.tokens:
+            sess.close()
+
+
+class ModelRuntime(object):
+    def __init__(self, num_sessions=1, inter_op_threads=0, intra_op_threads=0):
+        """
+        process-wide cache of built graphs and their sessions, keyed by an architecture signature, e.g.
+        ('softmax', input_dim, num_classes). models of the same architecture share one entry and their params are
+        swapped in by assign ops, so that repeated fit/load/predict cycles build each graph once. safe to use from
+        several threads
+        :param num_sessions: sessions per entry, the number of callers of one architecture running in parallel
+        :param inter_op_threads: of each session, 0 for the tensorflow default
+        :param intra_op_threads: of each session, 0 for the tensorflow default
+        """
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.configure(num_sessions, inter_op_threads, intra_op_threads)
+
+    def configure(self, num_sessions=1, inter_op_threads=0, intra_op_threads=0):
+        """
+        set the pool size and threading of the sessions, the cached entries are dropped
+        """
+        self.clear()
+        with self.lock:
+            self.num_sessions = num_sessions
+            self.config = tf.ConfigProto(inter_op_parallelism_threads=inter_op_threads,
+                                         intra_op_parallelism_threads=intra_op_threads)
+
+    def get(self, signature, build):
+        """
+        :param signature: hashable, identifies everything in the graph but the values of the variables
+        :param build: called on a miss, returns the GraphWrapper of the signature. concurrent callers of a missing
+            signature wait for one build
+        :return: RuntimeEntry
+        """
+        with self.lock:
+            if signature not in self.entries:
+                self.entries[signature] = RuntimeEntry(build(), self.num_sessions, self.config)
+            return self.entries[signature]
+
+    def clear(self):
+        """
+        close all the sessions and forget the graphs
+        """
+        with self.lock:
+            for entry in self.entries.itervalues():
+                entry.close()
+            self.entries = {}
+
+
+RUNTIME = ModelRuntime()
@@ -0,0 +1,153 @@
+# coding=utf-8
+import numpy as np
+
+
+def new_rng(seed=None):
+    """
+    :return: np.random.Generator when numpy provides it, which draws float32 uniforms straight into a buffer,
+        np.random.RandomState otherwise
+    """
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
+
+
+# RandomState only draws float64 into a new array, uniform fills out in blocks of this many draws. a 64 KB block stays
+# below the mmap threshold of malloc, the freed block is handed back by the next draw instead of fresh pages being
+# mapped, and the memory on top of the buffers is the same whatever the size of out
+UNIFORM_BLOCK = 8192
+
+
+def uniform(rng, out):
+    """
+    fill out with uniforms in [0, 1)
+    :param rng: from new_rng
+    :param out: np.ndarray, float32, contiguous
+    :return: out
+    """
+    if hasattr(rng, 'integers'):
+        rng.random(out=out, dtype=np.float32)
+        return out
+    flat = out.reshape(-1)
+    for start in range(0, flat.size, UNIFORM_BLOCK):
+        stop = min(start + UNIFORM_BLOCK, flat.size)
+        flat[start:stop] = rng.random_sample(stop - start)
+    return out
+
+
+def sigmoid(x, out=None):
+    """
+    1 / (1 + exp(-x)), computed in place in out
+    :param x: np.ndarray
+    :param out: np.ndarray of the shape of x, may be x itself, allocated if None
+    :return: out
+    """
+    out = np.negative(x, out=out)
+    np.exp(out, out=out)
+    np.add(out, 1.0, out=out)
+    np.reciprocal(out, out=out)
+    return out
+
+
+def sample_binomial(proba, rng, uniform_buffer, out=None):
+    """
+    :param proba: success probability, np.ndarray of float32
+    :param rng: from new_rng
+    :param uniform_buffer: np.ndarray of float32, the shape of proba, scratch space for the uniforms
+    :param out: np.ndarray of float32, the shape of proba, may be proba itself, allocated if None
+    :return: out, {0, 1}
+    """
+    uniform(rng, uniform_buffer)
+    return np.less(uniform_buffer, proba, out=out)
+
+
+def hidden_preactivation(v, W, c, sparse_threshold=None, out=None):
+    """
+    c + v W. when the fraction of non-zeros of v is below sparse_threshold, the rows of W of the active units are
+    gathered and summed per row instead of running the dense matmul over all visible units
+    :param v: 2d np.ndarray, (N, n_visible)
+    :param W: 2d np.ndarray, (n_visible, n_hidden)
+    :param c: 1d np.ndarray, (n_hidden, )
+    :param sparse_threshold: density below which the sparse path is taken, None for always dense
+    :param out: 2d np.ndarray, (N, n_hidden), allocated if None
+    :return: out
+    """
+    if out is None:
+        out = np.empty((v.shape[0], W.shape[1]), np.result_type(v, W))
+    if sparse_threshold is None or np.count_nonzero(v) >= sparse_threshold * v.size:
+        np.dot(v, W, out=out)
+        np.add(out, c, out=out)
+        return out
+    out[...] = c
+    rows, cols = np.nonzero(v)
+    if len(rows) == 0:
+        return out
+    gathered = W[cols]
+    values = v[rows, cols]
+    if not np.all(values == 1):
+        gathered *= values.reshape((-1, 1))
+    # np.nonzero goes in row-major order, so the active units of each row are contiguous
+    counts = np.bincount(rows, minlength=v.shape[0])
+    active = counts > 0
+    starts = np.cumsum(counts) - counts
+    out[active] += np.add.reduceat(gathered, starts[active], axis=0)
+    return out
+
+
+class GibbsBuffers(object):
+    def __init__(self, n_visible, n_hidden, num_rows, seed=None):
+        """
+        float32 buffers for the Gibbs steps of an RBM on up to num_rows rows, grown on demand by reserve. the arrays
+        returned by the kernels are views of these buffers and get overwritten by the next call of the same kernel
+        :param n_visible:
+        :param n_hidden:
+        :param num_rows:
+        :param seed:
+        """
+        self.n_visible = n_visible
+        self.n_hidden = n_hidden
+        self.num_rows = 0
+        self.rng = new_rng(seed)
+        self.reserve(num_rows)
+
+    def reserve(self, num_rows):
+        """
+        make room for num_rows rows
+        """
+        if num_rows <= self.num_rows:
+            return
+        self.num_rows = num_rows
+        self.h = np.empty((num_rows, self.n_hidden), np.float32)
+        self.h_uniform = np.empty((num_rows, self.n_hidden), np.float32)
+        self.v = np.empty((num_rows, self.n_visible), np.float32)
+        self.v_uniform = np.empty((num_rows, self.n_visible), np.float32)
+
+    def sample_h_given_v(self, v, W, c, sparse_threshold=None):
+        """
+        :param v: 2d np.ndarray of float32, (N, n_visible)
+        :param W: 2d np.ndarray of float32, (n_visible, n_hidden)
+        :param c: 1d np.ndarray of float32, (n_hidden, )
+        :param sparse_threshold: see hidden_preactivation
+        :return: view of the h buffer, (N, n_hidden)
+        """
+        n = v.shape[0]
+        self.reserve(n)
+        h = self.h[:n]
+        hidden_preactivation(v, W, c, sparse_threshold, out=h)
+        sigmoid(h, out=h)
+        return sample_binomial(h, self.rng, self.h_uniform[:n], out=h)
+
+    def sample_v_given_h(self, h, W, b):
+        """
+        :param h: 2d np.ndarray of float32, (N, n_hidden)
+        :param W: 2d np.ndarray of float32, (n_visible, n_hidden)
+        :param b: 1d np.ndarray of float32, (n_visible, )
+        :return: view of the v buffer, (N, n_visible)
+        """
+        n = h.shape[0]
+        self.reserve(n)
+        v = self.v[:n]
+        np.dot(h, W.T, out=v)
+        np.add(v, b, out=v)
+        sigmoid(v, out=v)
+        return sample_binomial(v, self.rng, self.v_uniform[:n], out=v)
@@ -0,0 +1,144 @@
+# coding=utf-8
+import json
+import threading
+import SocketServer
+import BaseHTTPServer
+import numpy as np
+
+from softmax import SoftmaxRegressor
+from fnn import FCNN
+from fm import FactorMach
+from batching import MicroBatcher
+
+MODEL_KINDS = {'softmax': SoftmaxRegressor, 'fcnn': FCNN, 'fm': FactorMach}
+
+
+def input_dim_of(kind, params):
+    """
+    :return: number of features the model expects
+    """
+    if kind == 'softmax':
+        return params['W'].shape[0]
+    if kind == 'fcnn':
+        return params['W_h1'].shape[0]
+    return params['V'].shape[0]
+
+
+class ServedModel(object):
+    def __init__(self, kind, path, max_batch_size=64, max_wait_us=1000):
+        """
+        a saved model loaded once, warmed up, and answered through a MicroBatcher, whose thread runs the session
+        calls off the request threads
+        :param kind: key of MODEL_KINDS
+        :param path: as given to the save method of the model
+        """
+        if kind not in MODEL_KINDS:
+            raise Exception("unknown model kind {k}".format(k=kind))
+        self.kind = kind
+        self.model = MODEL_KINDS[kind]()
+        self.model.load(path)
+        self.input_dim = input_dim_of(kind, self.model.params)
+        # the factorisation machine gives one score per row, the classifiers one row of probas
+        predict_fn = self.model.predict_proba if kind != 'fm' else self.model.predict
+        # the first call builds the graph and pushes the params, keep it out of the first request
+        predict_fn(np.zeros((1, self.input_dim), dtype=np.float32))
+        self.batcher = MicroBatcher(predict_fn, max_batch_size, max_wait_us, input_dim=self.input_dim)
+
+    def describe(self):
+        return {'kind': self.kind, 'input_dim': self.input_dim}
+
+
+class PredictionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /models: the served models
+    GET /stats/<name>: latency percentiles and batch sizes of a model, see MicroBatcher.stats
+    POST /predict/<name>: body {"x": [[...], ...]}, answers {"y": [...]}
+    """
+    # keep-alive, so that a client reuses its connection across requests
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['models']:
+            self.__reply__(200, dict([(name, m.describe()) for name, m in self.server.models.iteritems()]))
+        elif len(parts) == 2 and parts[0] == 'stats' and parts[1] in self.server.models:
+            stats = self.server.models[parts[1]].batcher.stats()
+            stats['batch_sizes'] = dict([(str(k), v) for k, v in stats['batch_sizes'].iteritems()])
+            self.__reply__(200, stats)
+        else:
+            self.__reply__(404, {'error': 'not found'})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        if not (len(parts) == 2 and parts[0] == 'predict' and parts[1] in self.server.models):
+            self.__reply__(404, {'error': 'not found'})
+            return
+        served = self.server.models[parts[1]]
+        try:
+            x = np.asarray(json.loads(body)['x'], dtype=np.float32)
+            if x.ndim == 1:
+                x = x.reshape((1, -1))
+            if x.ndim != 2 or x.shape[1] != served.input_dim:
+                raise ValueError("x should have {d} columns".format(d=served.input_dim))
+        except (ValueError, KeyError, TypeError) as e:
+            self.__reply__(400, {'error': str(e)})
+            return
+        try:
+            y = served.batcher.predict(x, timeout=self.server.timeout_sec)
+        except Exception as e:
+            self.__reply__(500, {'error': str(e)})
+            return
+        self.__reply__(200, {'y': y.tolist()})
+
+    def __reply__(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # one line per request would dominate the load test
+        pass
+
+
+class PredictionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # the default of 5 drops connections under a burst of concurrent clients
+    request_queue_size = 1024
+
+    def __init__(self, models, host='127.0.0.1', port=8000, timeout_sec=10.0):
+        """
+        HTTP server answering every connection in its own thread, the model compute being funnelled into the batcher
+        of each model
+        :param models: dict, name -> ServedModel
+        :param timeout_sec: longest wait of a request for its batch
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), PredictionHandler)
+        self.models = models
+        self.timeout_sec = timeout_sec
+
+
+def serve(model_specs, host='127.0.0.1', port=8000, max_batch_size=64, max_wait_us=1000, background=False):
+    """
+    :param model_specs: dict, name -> (kind, path), e.g. {'softmax': ('softmax', 'model')}
+    :param background: if True, serve from a daemon thread and return the server, otherwise serve forever
+    :return: PredictionServer
+    """
+    models = dict([(name, ServedModel(kind, path, max_batch_size, max_wait_us)) for name, (kind, path) in model_specs.iteritems()])
+    server = PredictionServer(models, host, port)
+    print 'serving {m} on http://{h}:{p}'.format(m=', '.join(sorted(models.keys())), h=host, p=port)
+    if background:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+    server.serve_forever()
+    return server
+
+
+if __name__ == '__main__':
+    # the model saved by the __main__ of softmax.py
+    serve({'softmax': ('softmax', 'model')})
@@ -1,44 +1,31 @@
 # coding=utf-8
 import numpy as np
 import tensorflow as tf
-import cPickle
 from tensorflow.examples.tutorials.mnist import input_data
 
-class Struct(dict):
-    def __init__(self, **kwargs):
-        super(Struct, self).__init__(**kwargs)
-        self.__dict__ = self
-
-
-class GraphWrapper(object):
-    def __init__(self, graph, phr, var, tsr, ops):
-        self.graph = graph
-        self.phr = phr
-        self.var = var
-        self.tsr = tsr
-        self.ops = ops
+from util import Struct, GraphWrapper, auto_chunk_size, iterate_chunks, write_chunks
+from runtime import RUNTIME, new_token
+from model_io import save_params, load_params
 
 
 class SoftmaxRegressor(object):
     def __init__(self):
         # 模型的参数,对应于Graph中的trainable variables
         self.params = {}
-        # Graph and session for online running
-        self.updated = False
-        self.G_run = None
-        self.sess_run = None
-        
-    def __build_graph__(self, input_dim=None, num_classes=None, var_val=None):
+        # identifies the current params to the shared runtime, see runtime.new_token
+        self.token = None
+
+    def __runtime__(self, input_dim, num_classes):
+        """
+        :return: runtime.RuntimeEntry of the graph of this architecture, built on the first call only
+        """
+        return RUNTIME.get(('softmax', input_dim, num_classes), lambda: self.__build_graph__(input_dim, num_classes))
+
+    def __build_graph__(self, input_dim, num_classes):
         graph = tf.Graph()
         with graph.as_default():
-            if var_val is not None:
-                input_dim = var_val['W'].shape[0]
-                num_classes = var_val['W'].shape[1]
-                W = tf.Variable(var_val['W'])
-                b = tf.Variable(var_val['b'])
-            else:
-                W = tf.Variable(tf.zeros([input_dim, num_classes]))
-                b = tf.Variable(tf.zeros([num_classes]))
+            W = tf.Variable(tf.zeros([input_dim, num_classes]))
+            b = tf.Variable(tf.zeros([num_classes]))
             x = tf.placeholder(tf.float32, [None, input_dim])
             y_ = tf.placeholder(tf.float32, [None, num_classes])
             learning_rate = tf.placeholder(tf.float32)
@@ -67,44 +54,58 @@ class SoftmaxRegressor(object):
         input_dim = x.shape[1]
         num_classes = y.max() + 1
         y = self.__ordinal_to_onehot__(y)
-        G = self.__build_graph__(input_dim, num_classes)
-        sess = tf.Session(graph=G.graph)
-        with sess.as_default():
-            G.ops.init_vars.run()
-            head = 0
-            indices = range(num_samples)
-            for i in range(num_epochs):
-                if head + batch_size > num_samples:
-                    indices = np.random.permutation(num_samples)
-                    head = 0
-                selected = indices[head: head + batch_size]
-                head += batch_size
-                batch_x = x[selected]
-                batch_y = y[selected]
-                if verbose:
-                    if i % 100 == 0:
-                        accuracy = G.tsr.accuracy.eval(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y})
-                        print 'step {s}, accuracy on the training batch is {a:.2f}%'.format(s=i, a=accuracy * 100.0)
-                G.ops.train_step.run(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y, G.phr.learning_rate: learning_rate})
-            for k, v in G.var.iteritems():
-                self.params[k] = G.var[k].eval()
-        self.updated = True         
+        entry = self.__runtime__(input_dim, num_classes)
+        G = entry.G
+        with entry.training_session() as sess:
+            with sess.as_default():
+                head = 0
+                indices = range(num_samples)
+                for i in range(num_epochs):
+                    if head + batch_size > num_samples:
+                        indices = np.random.permutation(num_samples)
+                        head = 0
+                    selected = indices[head: head + batch_size]
+                    head += batch_size
+                    batch_x = x[selected]
+                    batch_y = y[selected]
+                    if verbose:
+                        if i % 100 == 0:
+                            accuracy = G.tsr.accuracy.eval(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y})
+                            print 'step {s}, accuracy on the training batch is {a:.2f}%'.format(s=i, a=accuracy * 100.0)
+                    G.ops.train_step.run(feed_dict={G.phr.x: batch_x, G.phr.y_: batch_y, G.phr.learning_rate: learning_rate})
+            self.token = new_token()
+            self.params = entry.fetch(sess)
                 
-    def predict_proba(self, x):
+    def predict_proba(self, x, out=None, chunk_size=None, memory_budget=64 * 2 ** 20):
         """
-        :param x:
+        :param x: 2d np.ndarray, np.memmap, list of rows or iterator of 2d np.ndarray, scored chunk by chunk
+        :param out: 2d np.ndarray (N, num_classes), possibly a np.memmap, the probas are written into it when given,
+            so that peak memory depends on the chunk size only
+        :param chunk_size: rows per session run, derived from memory_budget if None
+        :param memory_budget: bytes held by one chunk, input, logits and probas
         :return: np.2darray, each row gives the proba of an instance belonging to each class
         """
+        num_classes = self.params['W'].shape[1] if len(self.params) > 0 else 0
+        if out is None and hasattr(x, 'shape'):
+            out = np.empty((x.shape[0], num_classes), dtype=np.float32)
+        return write_chunks(self.iter_predict_proba(x, chunk_size, memory_budget), num_classes, out)
+
+    def iter_predict_proba(self, x, chunk_size=None, memory_budget=64 * 2 ** 20):
+        """
+        streaming counterpart of predict_proba
+        :return: iterator of 2d np.ndarray, the probas of consecutive chunks of x
+        """
         if len(self.params) < 1:
             raise Exception("empty model")
-        if self.updated:
-            self.G_run = self.__build_graph__(var_val=self.params)
-            if self.sess_run is not None: self.sess_run.close()
-            self.sess_run = tf.Session(graph=self.G_run.graph)
-            self.sess_run.run(self.G_run.ops.init_vars)
-            self.updated = False
-        proba = self.sess_run.run(self.G_run.tsr.y, feed_dict={self.G_run.phr.x: x})
-        return proba
+        input_dim, num_classes = self.params['W'].shape
+        entry = self.__runtime__(input_dim, num_classes)
+        if chunk_size is None:
+            chunk_size = auto_chunk_size(4 * (input_dim + 2 * num_classes), memory_budget)
+        for chunk in iterate_chunks(x, chunk_size):
+            # a session is held per chunk only, not while the caller consumes the probas
+            with entry.session(self.params, self.token) as sess:
+                proba = sess.run(entry.G.tsr.y, feed_dict={entry.G.phr.x: chunk})
+            yield proba
 
     def predict(self, x):
         """
@@ -115,24 +116,25 @@ class SoftmaxRegressor(object):
         return np.argmax(proba, 1)
 
     def save(self, path):
+        """
+        :param path: directory, see model_io.save_params
+        """
         if len(self.params) < 1:
             raise Exception("empty model")
-        with open(path, "wb") as f:
-            cPickle.dump(self.params, f)
+        save_params(path, self.params)
 
-    def load(self, path):
-        with open(path, "rb") as f:
-            self.params = cPickle.load(f)
-        self.updated = True
+    def load(self, path, mmap=True):
+        """
+        :param path: directory written by save, or a file written by the former cPickle format
+        :param mmap: if True the params are memory-mapped, see model_io.load_params
+        """
+        self.params = load_params(path, mmap)
+        self.token = new_token()
 
     def __ordinal_to_onehot__(self, y):
         yy = np.zeros((y.shape[0], y.max()+1), dtype=np.int32)
         yy[np.arange(y.shape[0]), y] = 1
         return yy
-    
-    def __del__(self):
-        if self.sess_run is not None:
-            self.sess_run.close()
 
 if __name__ == '__main__':
     mnist = input_data.read_data_sets("MNIST_data/", one_hot=False)
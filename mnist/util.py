@@ -1,6 +1,9 @@
 # coding=utf-8
 import tensorflow as tf
 import numpy as np
+import threading
+import traceback
+import collections
 
 class Struct(dict):
     def __init__(self, **kwargs):
@@ -17,6 +20,82 @@ class GraphWrapper(object):
         self.ops = ops
 
 
+class BackgroundWorker(object):
+    def __init__(self, max_results=1):
+        """
+        a daemon thread running the jobs submitted to it one at a time, off the training loop. a job submitted while
+        another is waiting replaces it, so that a slow job never builds up a backlog of stale snapshots. close stops
+        the thread
+        :param max_results: number of the last results kept, all of them if None
+        """
+        self.cond = threading.Condition()
+        self.pending = None
+        self.busy = False
+        self.closed = False
+        self.results = collections.deque(maxlen=max_results)
+        self.thread = threading.Thread(target=self.__run__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, key, fn, *args):
+        """
+        :param key: stored along with the result, e.g. the training step
+        :param fn: called as fn(*args) in the worker thread
+        """
+        with self.cond:
+            if self.closed:
+                raise Exception("submit to a closed BackgroundWorker")
+            self.pending = (key, fn, args)
+            self.cond.notify_all()
+
+    def latest(self):
+        """
+        :return: (key, result) of the last finished job, None if none has finished
+        """
+        with self.cond:
+            return self.results[-1] if len(self.results) > 0 else None
+
+    def join(self):
+        """
+        wait until the submitted jobs are done
+        """
+        with self.cond:
+            while self.pending is not None or self.busy:
+                self.cond.wait()
+
+    def close(self):
+        """
+        stop the thread: a job still waiting is dropped, a running one is waited for. the results stay readable
+        """
+        with self.cond:
+            self.closed = True
+            self.pending = None
+            self.cond.notify_all()
+        self.thread.join()
+
+    def __run__(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                key, fn, args = self.pending
+                self.pending = None
+                self.busy = True
+            try:
+                result = fn(*args)
+            except Exception:
+                # keep serving the next jobs
+                traceback.print_exc()
+                result = None
+            with self.cond:
+                if result is not None:
+                    self.results.append((key, result))
+                self.busy = False
+                self.cond.notify_all()
+
+
 def iterate_dataset(x, y=None, batch_size=50, seed=None):
     """
     generate a iterator over the given dataset
@@ -43,6 +122,99 @@ def iterate_dataset(x, y=None, batch_size=50, seed=None):
         else:
             yield x[selected]
 
+
+def auto_chunk_size(bytes_per_row, memory_budget):
+    """
+    :param bytes_per_row: bytes held per row while a chunk is scored, input, activations and output together
+    :param memory_budget: bytes
+    :return: number of rows per chunk, at least 1
+    """
+    return max(1, int(memory_budget // bytes_per_row))
+
+
+def iterate_chunks(x, chunk_size):
+    """
+    go through the rows of x in chunks, reading only the current chunk of a memory-mapped x
+    :param x: 2d np.ndarray, np.memmap, list or tuple of rows, or an iterator of 2d np.ndarray, whose batches are
+        split when larger than chunk_size
+    :param chunk_size:
+    :return: iterator of 2d np.ndarray of at most chunk_size rows
+    """
+    if isinstance(x, (list, tuple)):
+        x = np.asarray(x, dtype=np.float32)
+    if not hasattr(x, 'shape'):
+        if not hasattr(x, 'next'):
+            raise Exception("iterate_chunks: expected an array, a list of rows or an iterator of batches, got {t}".format(t=type(x).__name__))
+        for batch in x:
+            for a in range(0, batch.shape[0], chunk_size):
+                yield batch[a: a + chunk_size]
+        return
+    for a in range(0, x.shape[0], chunk_size):
+        yield x[a: a + chunk_size]
+
+
+def write_chunks(chunks, num_columns, out=None):
+    """
+    :param chunks: iterator of 2d np.ndarray of num_columns columns
+    :param out: 2d np.ndarray with as many rows as the chunks altogether, possibly a np.memmap, the chunks are
+        concatenated if None
+    :return: out
+    """
+    if out is None:
+        chunks = list(chunks)
+        if len(chunks) == 0:
+            return np.zeros((0, num_columns), dtype=np.float32)
+        return np.concatenate(chunks)
+    a = 0
+    for chunk in chunks:
+        out[a: a + chunk.shape[0]] = chunk
+        a += chunk.shape[0]
+    if a != out.shape[0]:
+        raise Exception("write_chunks: {n} rows written into an output of {m} rows".format(n=a, m=out.shape[0]))
+    return out
+
+class PackedBinaryDataset(object):
+    def __init__(self, packed, n_columns):
+        """
+        binary dataset stored at one bit per unit, rows are unpacked to float32 only when indexed, so that
+        iterate_dataset unpacks nothing but the minibatches it draws
+        :param packed: 2d np.ndarray of uint8, (N, ceil(n_columns / 8)), as given by np.packbits(x, axis=1), may be
+            memory-mapped
+        :param n_columns: number of binary units per row
+        """
+        self.packed = packed
+        self.n_columns = n_columns
+        self.shape = (packed.shape[0], n_columns)
+
+    @staticmethod
+    def from_dense(x, chunk_size=10000):
+        """
+        :param x: 2d np.ndarray, any non-zero is taken as 1
+        :param chunk_size: rows packed at a time, bounds the temporaries
+        :return: PackedBinaryDataset
+        """
+        packed = np.zeros((x.shape[0], (x.shape[1] + 7) // 8), dtype=np.uint8)
+        for a in range(0, x.shape[0], chunk_size):
+            packed[a: a + chunk_size] = np.packbits(x[a: a + chunk_size] != 0, axis=1)
+        return PackedBinaryDataset(packed, x.shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        """
+        :param rows: anything that indexes the rows of an np.ndarray
+        :return: np.ndarray of float32, {0, 1}
+        """
+        packed = self.packed[rows]
+        if packed.ndim == 1:
+            return np.float32(np.unpackbits(packed)[:self.n_columns])
+        return np.float32(np.unpackbits(packed, axis=1)[:, :self.n_columns])
+
+    def to_dense(self):
+        return self[:]
+
+
 def ordinal_to_onehot(y, nbits=None):
     """
     :param y: 1d np.ndarray, starting from zero
@@ -56,12 +228,15 @@ def ordinal_to_onehot(y, nbits=None):
     return yy
 
 
-def sample_binomial(proba):
+def sample_binomial(proba, rng=None):
     """
     :param proba: success probability, 1d np.ndarray
+    :param rng: np.random.RandomState, the global one if None. threads sampling concurrently should own one each
     :return:
     """
-    return np.float32(np.random.uniform(low=0.0, high=1.0, size=proba.shape) < proba)
+    if rng is None:
+        rng = np.random
+    return np.float32(rng.uniform(low=0.0, high=1.0, size=proba.shape) < proba)
 
 
 def sigmoid(x):
@@ -3,6 +3,12 @@ import tensorflow as tf
 from tensorflow.python.ops import array_ops
 import numpy as np
 import cPickle
+import os
+import sys
+
+# model_io is shared with mnist/, whose directory is searched after this one
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'mnist'))
+from model_io import save_params
 
 
 class BasicLSTM(object):
@@ -142,4 +148,5 @@ if __name__ == '__main__':
             for var in lstm.var_names:
                 with tf.variable_scope(type(lstm).__name__, reuse=True):
                     var_list.append(sess.run(tf.get_variable(var)))
-            cPickle.dump((var_list, loss), open("model/lstm_epoch{ep}.pkl".format(ep=epoch+1), "wb"))
+            save_params("model/lstm_epoch{ep}".format(ep=epoch+1), dict(zip(lstm.var_names, var_list)),
+                        meta={'loss': float(loss), 'var_names': lstm.var_names})
@@ -3,9 +3,15 @@ import tensorflow as tf
 from tensorflow.python.ops import array_ops
 import numpy as np
 import cPickle
+import os
+import sys
 from PIL import Image
 import matplotlib.pyplot as plt
 
+# model_io is shared with mnist/, whose directory is searched after this one
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'mnist'))
+from model_io import load_params, load_meta
+
 
 if __name__ == '__main__':
     dataset = cPickle.load(open('MNIST_data/mnist_seq.pkl', 'rb'))
@@ -54,7 +60,14 @@ if __name__ == '__main__':
     valid_set = dataset[split_point :]
     print '{nt} training samples, {nv} validation samples'.format(nt=len(train_set), nv=len(valid_set))
 
-    var_list, valid_loss = cPickle.load(open("model/lstm_epoch6.pkl", "rb"))
+    if os.path.isdir("model/lstm_epoch6"):
+        params = load_params("model/lstm_epoch6")
+        meta = load_meta("model/lstm_epoch6")
+        var_list = [params[var] for var in meta['var_names']]
+        valid_loss = meta['loss']
+    else:
+        # dumped by the former cPickle format
+        var_list, valid_loss = load_params("model/lstm_epoch6.pkl")
     print valid_loss
     Wf, bf, Wi, bi, Wo, bo, Wc, bc, Wout, bout = var_list
     x = tf.placeholder(dtype=tf.float32, shape=input_size)